@@ -1,9 +1,13 @@
+import click
 import datetime
+import math
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from decimal import Decimal
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 from sqlalchemy import func
+from tqdm import tqdm  # type: ignore
 
 from backend.database import connection, models, crud
 from backend.config import config, logger
@@ -76,27 +80,83 @@ def populate_live_prices(db: Session):
 
 
 def populate_position(db: Session):
-    """Populates the current position"""
+    """Populates the open lots and current position"""
     logger.info("Populating current positions...")
     end_date = db.query(func.max(models.Trade.date)).scalar()
     assert end_date, "Please load trades before populating position"
 
-    positions = crud.build_positions_from_trades(db, end_date=end_date)
-    crud.store_positions(db, positions)
+    crud.rebuild_open_lots(db)
 
 
-def backfill_historical_positions(db: Session):
-    """Backfills position snapshots for each date"""
+def _init_partition_worker():
+    """Drops any DB connections inherited from the parent so each worker opens its own"""
+    connection.engine.dispose(close=False)
+
+
+def _backfill_partition(
+    checkpoint_name: str, target_dates: list[str], initial_lots: dict[str, list[dict]]
+):
+    """Backfills the position snapshots for a single partition of dates in a worker process"""
+    with connection.SessionLocal() as db:
+        crud.backfill_historical_positions(
+            db,
+            target_dates,
+            checkpoint_name=checkpoint_name,
+            initial_lots=initial_lots,
+        )
+
+
+def _backfill_historical_positions_parallel(db: Session, target_dates: list[str], workers: int):
+    """
+    Splits the dates into one contiguous partition per worker and backfills them in parallel
+    Each worker is seeded with the lots as of the day before its partition, so it only has
+    to replay the trades within its own date range
+    """
+    if not target_dates:
+        return
+
+    partition_size = math.ceil(len(target_dates) / workers)
+    partitions = [target_dates[i : i + partition_size] for i in range(0, len(target_dates), partition_size)]
+
+    day_before_partitions = [
+        str(datetime.date.fromisoformat(dates[0]) - datetime.timedelta(days=1)) for dates in partitions
+    ]
+    lot_states = crud.get_lot_states(db, day_before_partitions)
+
+    # Checkpoint every partition up front, so one whose worker dies before its first
+    # commit is still picked up by `jobs --positions --resume`
+    checkpoint_names = [f"{crud.HISTORICAL_POSITIONS_CHECKPOINT}-{i}" for i in range(len(partitions))]
+    crud.start_checkpoints(db, dict(zip(checkpoint_names, partitions)))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_partition_worker) as executor:
+        futures = [
+            executor.submit(_backfill_partition, name, dates, lot_states[day_before])
+            for name, dates, day_before in zip(checkpoint_names, partitions, day_before_partitions)
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Backfilling partitions"):
+            future.result()
+
+
+def backfill_historical_positions(db: Session, workers: int = 1):
+    """
+    Backfills position snapshots for each date
+    Snapshots are committed in chunks, so an interrupted backfill can be resumed with
+    `jobs --positions --resume`
+    """
     logger.info("Backfilling position snapshots...")
     start_date = db.query(func.min(models.Trade.date)).scalar()
     end_date = db.query(func.max(models.HistoricalPrice.date)).scalar()
     target_dates = [str(start_date + datetime.timedelta(days=i)) for i in range(1, (end_date - start_date).days)]
 
-    historical_positions = crud.build_historical_positions(db, target_dates, log_progress=True)
-    crud.store_historical_positions(db, historical_positions)
+    if workers > 1:
+        _backfill_historical_positions_parallel(db, target_dates, workers=workers)
+    else:
+        crud.backfill_historical_positions(db, target_dates, log_progress=True)
 
 
-def main():
+@click.command()
+@click.option("--workers", default=1, help="Number of processes to backfill position snapshots with")
+def main(workers: int):
     models.Base.metadata.create_all(connection.engine)
     backfill_trades()
     backfill_prices()
@@ -104,7 +164,7 @@ def main():
     with connection.SessionLocal() as db:
         populate_position(db)
         populate_live_prices(db)
-        backfill_historical_positions(db)
+        backfill_historical_positions(db, workers=workers)
 
 
 if __name__ == "__main__":
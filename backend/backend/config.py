@@ -26,6 +26,10 @@ DURATION_TO_TIMEDELTA = {
     "5Y": datetime.timedelta(days=365 * 5),
 }
 
+MARKET_TIMEZONE = "America/New_York"
+MARKET_OPEN = datetime.time(9, 30)
+MARKET_CLOSE = datetime.time(16, 0)
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
@@ -112,6 +116,9 @@ class Config(BaseSettings):
 
     trades_data_dir: Path = Field(default=PROJECT_HOME / "data" / "trades" / "clean")
     prices_data_dir: Path = Field(default=PROJECT_HOME / "data" / "prices" / "clean")
+    price_response_cache_dir: Path = Field(
+        default=PROJECT_HOME / "data" / "prices" / "responses"
+    )
 
     coinbase_account_id: str = Field(alias="COINBASE_ACCOUNT_ID")
     ibkr_account_id: str = Field(alias="IBKR_ACCOUNT_ID")
@@ -165,8 +172,31 @@ class Config(BaseSettings):
         default="https://api.coingecko.com/api/v3/coins/{}/market_chart"
     )
 
-    price_cache_ttl_min: int = Field(default=5)
+    # Live prices are refreshed in the background, more often while the stock market is open
+    live_price_refresh_market_min: int = Field(default=5)
+    live_price_refresh_off_hours_min: int = Field(default=30)
+    price_request_timeout_sec: float = Field(default=10)
+    price_fetch_max_workers: int = Field(default=8)
+    tiingo_max_concurrency: int = Field(default=4)
+    coingecko_max_concurrency: int = Field(default=2)
+
+    # Free tier rate limits of each price provider, as (requests, per seconds)
+    finhub_rate_limit: tuple[int, int] = Field(default=(60, 60))
+    tiingo_rate_limit: tuple[int, int] = Field(default=(50, 60 * 60))
+    coingecko_rate_limit: tuple[int, int] = Field(default=(30, 60))
+    provider_max_retries: int = Field(default=3)
+    provider_backoff_sec: float = Field(default=1)
+    provider_max_retry_wait_sec: float = Field(default=60)
     trades_cache_ttl_min: int = Field(default=10)
+    performance_cache_size: int = Field(default=128)
+    gzip_minimum_size: int = Field(default=1000)
+    ibkr_max_concurrency: int = Field(default=4)
+    trade_scrape_timeout_sec: float = Field(default=120)
+    broker_keepalive_sec: int = Field(default=60)
+
+    positions_chunk_days: int = Field(default=90)
+    bulk_insert_batch_size: int = Field(default=1000)
+    bulk_copy_threshold: int = Field(default=10000)
 
     model_config = SettingsConfigDict(
         case_sensitive=True, env_file=PROJECT_HOME / ".env", extra="allow"
@@ -0,0 +1,146 @@
+import csv
+import io
+from typing import Any, Iterable
+from sqlalchemy import Table, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from backend.config import config
+from backend.database import models
+
+# Placeholder for NULL values in the COPY payload
+COPY_NULL = "\\N"
+
+
+def to_records(objects: Iterable[models.Base]) -> list[dict[str, Any]]:
+    """
+    Converts ORM objects into column -> value dicts for a bulk write
+    Missing values are filled with the column's python-side default, if it has one
+    """
+    records = []
+    for obj in objects:
+        record = {}
+        for column in obj.__table__.columns:
+            value = getattr(obj, column.key)
+            if (
+                value is None
+                and column.default is not None
+                and column.default.is_callable
+            ):
+                value = column.default.arg(None)  # type: ignore
+            record[column.key] = value
+        records.append(record)
+    return records
+
+
+def _dedupe(records: list[dict[str, Any]], keys: list[str]) -> list[dict[str, Any]]:
+    """
+    Postgres rejects an upsert that touches the same row twice in one statement,
+    so only the last record for each key is kept
+    """
+    return list(
+        {tuple(record[key] for key in keys): record for record in records}.values()
+    )
+
+
+def _insert_upsert(
+    db: Session,
+    table: Table,
+    records: list[dict[str, Any]],
+    keys: list[str],
+    update_columns: list[str],
+):
+    """Upserts the records with batched multi-row INSERT ... ON CONFLICT statements"""
+    batch_size = config.bulk_insert_batch_size
+    for i in range(0, len(records), batch_size):
+        stmt = insert(table).values(records[i : i + batch_size])
+        if update_columns:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=keys,
+                set_={column: stmt.excluded[column] for column in update_columns},
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=keys)
+        db.execute(stmt)
+
+
+def _copy_upsert(
+    db: Session,
+    table: Table,
+    records: list[dict[str, Any]],
+    keys: list[str],
+    update_columns: list[str],
+):
+    """
+    Upserts the records by streaming them into a temporary staging table with COPY,
+    and then merging the staging table into the target table with a single statement
+    """
+    columns = list(records[0].keys())
+    column_list = ", ".join(columns)
+    staging_table = f"{table.name}_staging"
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record in records:
+        writer.writerow(
+            [
+                COPY_NULL if record[column] is None else record[column]
+                for column in columns
+            ]
+        )
+    buffer.seek(0)
+
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
+        cursor.execute(
+            f"CREATE TEMP TABLE {staging_table} (LIKE {table.name} INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        cursor.copy_expert(
+            f"COPY {staging_table} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')",
+            buffer,
+        )
+    finally:
+        cursor.close()
+
+    if update_columns:
+        updates = ", ".join(
+            f"{column} = EXCLUDED.{column}" for column in update_columns
+        )
+        on_conflict = f"DO UPDATE SET {updates}"
+    else:
+        on_conflict = "DO NOTHING"
+
+    db.execute(
+        text(
+            f"INSERT INTO {table.name} ({column_list}) SELECT {column_list} FROM {staging_table} "
+            + f"ON CONFLICT ({', '.join(keys)}) {on_conflict}"
+        )
+    )
+    db.execute(text(f"DROP TABLE {staging_table}"))
+
+
+def upsert(
+    db: Session,
+    model: type[models.Base],
+    records: list[dict[str, Any]],
+    update_columns: list[str] | None = None,
+):
+    """
+    Inserts the records into the model's table, updating any rows that already exist
+    with the same primary key (all non-key columns are updated unless specified)
+    Small batches are written with multi-row INSERTs, while large batches are streamed
+    in with COPY. Nothing is committed, so the write joins the session's transaction
+    """
+    if not records:
+        return
+
+    table: Table = model.__table__  # type: ignore
+    keys = [column.key for column in table.primary_key.columns]
+    if update_columns is None:
+        update_columns = [column for column in records[0].keys() if column not in keys]
+
+    records = _dedupe(records, keys)
+    if len(records) >= config.bulk_copy_threshold:
+        _copy_upsert(db, table, records, keys, update_columns)
+    else:
+        _insert_upsert(db, table, records, keys, update_columns)
@@ -1,11 +1,22 @@
-from typing import Generator
+from typing import AsyncGenerator, Generator
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, Session
 from backend.config import config
 
 engine = create_engine(config.postgres_url, pool_size=15, max_overflow=10, pool_timeout=60)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for the API's read endpoints, so queries don't block the event loop
+async_engine = create_async_engine(
+    make_url(config.postgres_url).set(drivername="postgresql+asyncpg"),
+    pool_size=15,
+    max_overflow=10,
+    pool_timeout=60,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 
 def get_db() -> Generator[Session, None, None]:
     """Get DB session using context manager for automatic cleanup."""
@@ -14,3 +25,9 @@ def get_db() -> Generator[Session, None, None]:
         yield db
     finally:
         db.close()
+
+
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    """Get async DB session using context manager for automatic cleanup."""
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,21 +1,41 @@
+import copy
 import datetime
+import itertools
+from typing import Generator
 from sqlalchemy.orm import Session
-from backend.database import models
+from backend.database import models, bulk
+from backend.database.price_matrix import (
+    DECIMAL_PLACES,
+    PriceMatrix,
+    value_positions,
+    to_decimal,
+    to_date,
+)
+import numpy as np
 from decimal import Decimal
 from collections import defaultdict
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 from backend.config import config
 from tqdm import tqdm  # type: ignore
 
+HISTORICAL_POSITIONS_CHECKPOINT = "historical_positions"
+
 
 def get_trades(
-    db: Session, asset: str | None = None, date: datetime.date | None = None
+    db: Session,
+    asset: str | None = None,
+    date: datetime.date | None = None,
+    start_date: datetime.date | None = None,
 ):
-    """Returns all trades with optional asset filter"""
+    """Returns all trades with optional asset, date, or start date (inclusive) filters"""
     query = db.query(models.Trade).where(models.Trade.excluded.is_(False))
     if asset:
         query = query.where(models.Trade.asset == asset)
     if date:
         query = query.where(models.Trade.date == date)
+    if start_date:
+        query = query.where(models.Trade.date >= start_date)
     return query.all()
 
 
@@ -45,201 +65,704 @@ def get_all_positions(db: Session):
     return db.query(models.Position).all()
 
 
-def build_positions_from_trades(
-    db: Session, end_date: str | None = None
-) -> list[models.Position]:
+def get_open_lots(db: Session, asset: str | None = None):
+    """Returns the open buy lots in FIFO order with optional asset filter"""
+    query = db.query(models.OpenLot)
+    if asset:
+        query = query.where(models.OpenLot.asset == asset)
+    return query.order_by(models.OpenLot.asset, models.OpenLot.sequence).all()
+
+
+def _apply_trade_to_lots(buy_lots: list[dict], trade: models.Trade):
     """
-    Builds the current portfolio positions from the trade history on the specified dates
-    Dates are inclusive on both ends
-    Returns a list of Position objects, one for each asset
+    Applies a single trade to an asset's open buy lots (in place)
+    Buys open a new lot and sells close out the oldest lots first (FIFO)
     """
-    end_date = end_date or datetime.date.today().isoformat()
-    trades = (
-        db.query(models.Trade)
-        .where(models.Trade.date <= end_date)
-        .order_by(models.Trade.date)
+    if trade.excluded:
+        return
+
+    if trade.action == models.TradeAction.BUY:
+        buy_lots.append(
+            {
+                "quantity": trade.quantity,
+                "price": trade.price,
+                "trade_id": trade.id,
+                "date": to_date(trade.date),
+            }
+        )
+
+    elif trade.action == models.TradeAction.SELL:
+        remaining_to_sell = trade.quantity
+
+        # Sell from oldest lots first (FIFO)
+        while remaining_to_sell > 0 and buy_lots:
+            lot = buy_lots[0]
+
+            if lot["quantity"] <= remaining_to_sell:
+                # Sell entire lot
+                remaining_to_sell -= lot["quantity"]
+                buy_lots.pop(0)
+            else:
+                # Partial sell of lot
+                lot["quantity"] -= remaining_to_sell
+                remaining_to_sell = Decimal(0)
+
+
+def _position_from_lots(asset: str, buy_lots: list[dict]) -> models.Position | None:
+    """
+    Calculates the position totals from an asset's remaining buy lots
+    Returns None if there is no open quantity
+    """
+    total_quantity = sum(lot["quantity"] for lot in buy_lots)
+    if total_quantity == 0:
+        return None
+
+    total_cost = sum(lot["quantity"] * lot["price"] for lot in buy_lots)
+    average_price = total_cost / total_quantity
+
+    return models.Position(
+        asset=asset,
+        updated_at=datetime.datetime.now(datetime.timezone.utc),
+        average_price=average_price,
+        quantity=total_quantity,
+        cost=total_cost,
     )
 
-    # Group trades by asset
-    asset_trades = defaultdict(list)
-    for trade in trades:
-        if trade.asset not in config.assets.keys():
-            continue
-        asset_trades[trade.asset].append(trade)
 
-    # Build position for each asset
-    positions = []
-    for asset, trades_list in asset_trades.items():
-        # Use buy logs to correctly calculate average price when there's a sell
-        buy_lots = []  # Each lot: {'quantity': Decimal, 'price': Decimal}
+def _iter_lot_states(
+    db: Session,
+    target_dates: list[str],
+    assets: list[str] | None = None,
+    initial_lots: dict[str, list[dict]] | None = None,
+) -> Generator[tuple[str, dict[str, list[dict]]], None, None]:
+    """
+    Sweeps the trade history once in date order, carrying the FIFO lots forward
+    from one target date to the next
+    Yields (date, lots_by_asset) for each target date (in sorted order), after applying
+    every trade up to and including that date. The yielded lots are mutated as the sweep
+    continues, so they must be copied if they're kept
+
+    If initial_lots are provided, they must be the lots as of the day before the first
+    target date, and only the trades from the first target date onwards are applied
+    """
+    if not target_dates:
+        return
 
-        for trade in trades_list:
-            if trade.excluded:
+    # Only the columns are loaded (rather than ORM objects) so that the trades are not
+    # expired and re-queried if the caller commits while the sweep is in progress
+    sorted_dates = sorted(target_dates)
+    query = db.query(
+        models.Trade.id,
+        models.Trade.date,
+        models.Trade.action,
+        models.Trade.asset,
+        models.Trade.price,
+        models.Trade.quantity,
+        models.Trade.excluded,
+    ).where(models.Trade.date <= max(sorted_dates))
+    if assets:
+        query = query.where(models.Trade.asset.in_(assets))
+    if initial_lots is not None:
+        query = query.where(models.Trade.date >= min(sorted_dates))
+    trades = query.order_by(models.Trade.date, models.Trade.id).all()
+
+    # Lots are keyed by asset in order of each asset's first trade, so positions are
+    # emitted in a stable order
+    lots_by_asset: dict[str, list[dict]] = copy.deepcopy(initial_lots or {})
+    trade_index = 0
+    for end_date in sorted_dates:
+        end_date_obj = datetime.date.fromisoformat(end_date)
+
+        # Advance the sweep through all trades up to and including this date
+        while trade_index < len(trades) and trades[trade_index].date <= end_date_obj:
+            trade = trades[trade_index]
+            trade_index += 1
+            if trade.asset not in config.assets.keys():
                 continue
+            _apply_trade_to_lots(lots_by_asset.setdefault(trade.asset, []), trade)
 
-            if trade.action == models.TradeAction.BUY:
-                buy_lots.append({"quantity": trade.quantity, "price": trade.price})
+        yield end_date, lots_by_asset
 
-            elif trade.action == models.TradeAction.SELL:
-                remaining_to_sell = trade.quantity
 
-                # Sell from oldest lots first (FIFO)
-                while remaining_to_sell > 0 and buy_lots:
-                    lot = buy_lots[0]
+def get_lot_states(db: Session, dates: list[str]) -> dict[str, dict[str, list[dict]]]:
+    """
+    Returns the open FIFO lots of each asset as of each of the specified dates (inclusive)
+    Output is a mapping of date -> asset -> lots
+    """
+    return {
+        date: copy.deepcopy(lots_by_asset)
+        for (date, lots_by_asset) in _iter_lot_states(db, dates)
+    }
+
+
+def iter_position_snapshots(
+    db: Session,
+    target_dates: list[str],
+    assets: list[str] | None = None,
+    initial_lots: dict[str, list[dict]] | None = None,
+) -> Generator[tuple[str, list[models.Position]], None, None]:
+    """
+    Yields (date, positions) for each target date (in sorted order), where the positions
+    are those from replaying every trade up to and including that date
+    The trades are swept once across all dates, optionally restricted to a subset of
+    assets or starting from the lots as of the day before the first date
+    """
+    lot_states = _iter_lot_states(
+        db, target_dates, assets=assets, initial_lots=initial_lots
+    )
+    for end_date, lots_by_asset in lot_states:
+        positions = []
+        for asset, buy_lots in lots_by_asset.items():
+            position = _position_from_lots(asset, buy_lots)
+            if position:
+                positions.append(position)
+
+        yield end_date, positions
+
+
+def get_price_matrix(
+    db: Session,
+    start_date: str | datetime.date,
+    end_date: str | datetime.date,
+    assets: list[str] | None = None,
+) -> PriceMatrix:
+    """
+    Loads every historical price in the date window (inclusive) with a single query
+    and returns them as a dense asset x date matrix
+    Each asset's last price before the window seeds the forward fill, so as-of lookups
+    still work for dates at the start of the window without a price
+    """
+    query = (
+        db.query(
+            models.HistoricalPrice.asset,
+            models.HistoricalPrice.date,
+            models.HistoricalPrice.price,
+        )
+        .where(models.HistoricalPrice.date >= start_date)
+        .where(models.HistoricalPrice.date <= end_date)
+    )
+    if assets:
+        query = query.where(models.HistoricalPrice.asset.in_(assets))
 
-                    if lot["quantity"] <= remaining_to_sell:
-                        # Sell entire lot
-                        remaining_to_sell -= lot["quantity"]
-                        buy_lots.pop(0)
-                    else:
-                        # Partial sell of lot
-                        lot["quantity"] -= remaining_to_sell
-                        remaining_to_sell = Decimal(0)
+    previous_prices = get_latest_asset_prices(db, str(start_date), assets=assets)
+    return PriceMatrix.from_rows(query.all(), start_date, end_date, previous_prices)
 
-        # Calculate totals from remaining lots
-        total_quantity = sum(lot["quantity"] for lot in buy_lots)
-        if total_quantity == 0:
-            continue
 
-        total_cost = sum(lot["quantity"] * lot["price"] for lot in buy_lots)
-        average_price = total_cost / total_quantity
+def enrich_historical_positions(
+    price_matrix: PriceMatrix, snapshots: list[tuple[str, list[models.Position]]]
+) -> list[models.HistoricalPosition]:
+    """
+    Enrich each snapshot of positions with the historical price and downstream calculations
+    The quantities and costs are laid out on the same asset x date grid as the price matrix
+    so that the value and returns are calculated for every position in one batch
+    """
+    shape = price_matrix.prices.shape
+    quantities = np.zeros(shape, dtype=np.float64)
+    costs = np.zeros(shape, dtype=np.float64)
+
+    cells = []
+    for date, positions in snapshots:
+        column = price_matrix.date_index(date)
+        for position in positions:
+            daily_close_price = price_matrix.get_price(position.asset, date)
+            assert daily_close_price, (
+                f"Daily close price not found for {position.asset} on {date}"
+            )
 
-        position = models.Position(
-            asset=asset,
-            updated_at=datetime.datetime.now(datetime.timezone.utc),
-            average_price=average_price,
-            quantity=total_quantity,
-            cost=total_cost,
+            row = price_matrix.asset_index[position.asset]
+            quantities[row, column] = float(position.quantity)
+            costs[row, column] = float(position.cost)
+            cells.append((row, column, date, position, daily_close_price))
+
+    values, returns = value_positions(price_matrix.float_prices, quantities, costs)
+
+    # Only convert back to decimals at the storage boundary
+    return [
+        models.HistoricalPosition(
+            asset=position.asset,
+            date=date,
+            average_position_price=position.average_price,
+            daily_close_price=daily_close_price,
+            quantity=position.quantity,
+            cost=position.cost,
+            value=to_decimal(values[row, column]),
+            returns=to_decimal(returns[row, column]),
         )
-        positions.append(position)
+        for (row, column, date, position, daily_close_price) in cells
+    ]
 
-    return positions
 
+def iter_historical_positions(
+    db: Session,
+    target_dates: list[str],
+    chunk_size: int,
+    log_progress: bool = False,
+    assets: list[str] | None = None,
+    initial_lots: dict[str, list[dict]] | None = None,
+) -> Generator[tuple[list[str], list[models.HistoricalPosition]], None, None]:
+    """
+    Builds the historical positions for each of the specified dates in chunks of
+    consecutive dates, yielding (chunk_dates, historical_positions) for each chunk
+    The trade history is still swept once, but prices are loaded and valued one chunk
+    at a time so that only a single chunk is held in memory
+    """
+    if not target_dates:
+        return
 
-def enrich_historical_position(
-    db: Session, date: str, position: models.Position
-) -> models.HistoricalPosition:
-    """Enrich a position with the historical price and downstream calculations"""
-    asset_match = models.HistoricalPrice.asset == position.asset
-    date_match = models.HistoricalPrice.date == date
-    daily_close_price = (
-        db.query(models.HistoricalPrice.price)
-        .where(asset_match)
-        .where(date_match)
-        .scalar()
+    sorted_dates = sorted(target_dates)
+    snapshots = iter_position_snapshots(
+        db, sorted_dates, assets=assets, initial_lots=initial_lots
     )
-
-    if position.quantity != 0:
-        assert daily_close_price, (
-            f"Daily close price not found for {position.asset} on {date}"
+    if log_progress:
+        snapshots = tqdm(
+            snapshots, total=len(sorted_dates), desc="Building historical positions"
         )
-    else:
-        daily_close_price = Decimal(0)
 
-    value = position.quantity * daily_close_price
-    returns = (value - position.cost) / position.cost * 100
+    for i in range(0, len(sorted_dates), chunk_size):
+        chunk_dates = sorted_dates[i : i + chunk_size]
+        chunk_snapshots = list(itertools.islice(snapshots, len(chunk_dates)))
 
-    return models.HistoricalPosition(
-        asset=position.asset,
-        date=date,
-        average_position_price=position.average_price,
-        daily_close_price=daily_close_price,
-        quantity=position.quantity,
-        cost=position.cost,
-        value=value,
-        returns=returns,
-    )
+        price_matrix = get_price_matrix(
+            db, chunk_dates[0], chunk_dates[-1], assets=assets
+        )
+        yield chunk_dates, enrich_historical_positions(price_matrix, chunk_snapshots)
 
 
 def build_historical_positions(
-    db: Session, target_dates: list[str], log_progress: bool = False
+    db: Session,
+    target_dates: list[str],
+    log_progress: bool = False,
+    assets: list[str] | None = None,
 ) -> list[models.HistoricalPosition]:
     """
     Build the historical positions table for each of the specified dates
+    The trade history is replayed in a single pass rather than once per date, the
+    close prices for the whole window are loaded up front, and the valuation is batched
+    """
+    chunks = iter_historical_positions(
+        db,
+        target_dates,
+        chunk_size=max(len(target_dates), 1),
+        log_progress=log_progress,
+        assets=assets,
+    )
+    return [position for (_, positions) in chunks for position in positions]
+
+
+def get_checkpoints(db: Session, name: str) -> list[models.Checkpoint]:
+    """
+    Returns the in progress checkpoints for a chunked job, including the
+    checkpoints of each of its partitions (named "{name}-{partition}")
+    """
+    return (
+        db.query(models.Checkpoint)
+        .where(
+            (models.Checkpoint.name == name)
+            | models.Checkpoint.name.startswith(f"{name}-")
+        )
+        .order_by(models.Checkpoint.start_date)
+        .all()
+    )
+
+
+def start_checkpoints(db: Session, target_dates: dict[str, list[str]]):
     """
-    historical_positions = []
-    for end_date in (
-        tqdm(target_dates, desc="Building historical positions")
-        if log_progress
-        else target_dates
-    ):
-        positions_raw = build_positions_from_trades(db, end_date=end_date)
-        historical_positions += [
-            enrich_historical_position(db, end_date, position)
-            for position in positions_raw
-        ]
+    Records an empty checkpoint for each named chunked job before any work starts, so
+    a job that fails before committing its first chunk is still resumed from its start
+    Input is a mapping of checkpoint name -> dates the job will write
+    """
+    for name, dates in target_dates.items():
+        db.merge(
+            models.Checkpoint(
+                name=name, start_date=min(dates), end_date=max(dates), last_date=None
+            )
+        )
+    db.commit()
+
+
+def backfill_historical_positions(
+    db: Session,
+    target_dates: list[str],
+    log_progress: bool = False,
+    checkpoint_name: str = HISTORICAL_POSITIONS_CHECKPOINT,
+    initial_lots: dict[str, list[dict]] | None = None,
+):
+    """
+    Builds and stores the historical positions one chunk of dates at a time
+    Each chunk is committed along with a checkpoint of the last date written, so that
+    an interrupted backfill can be resumed from the next date. The checkpoint is
+    removed once every chunk has been written, or straight away if there's nothing
+    left to write (a run interrupted between its last chunk and the cleanup)
+    """
+    if target_dates:
+        start_date, end_date = min(target_dates), max(target_dates)
+        chunks = iter_historical_positions(
+            db,
+            target_dates,
+            chunk_size=config.positions_chunk_days,
+            log_progress=log_progress,
+            initial_lots=initial_lots,
+        )
+        for chunk_dates, historical_positions in chunks:
+            upsert_historical_positions(db, historical_positions)
+            db.merge(
+                models.Checkpoint(
+                    name=checkpoint_name,
+                    start_date=start_date,
+                    end_date=end_date,
+                    last_date=chunk_dates[-1],
+                )
+            )
+            db.commit()
 
-    return historical_positions
+    db.query(models.Checkpoint).where(
+        models.Checkpoint.name == checkpoint_name
+    ).delete()
+    db.commit()
 
 
 def store_live_prices(db: Session, price_data: dict[str, Decimal]):
     """
     Stores live price data in the DB
     Input is a mapping of asset -> price
+    Prices are upserted in a single statement, so readers never see an empty table and
+    any asset missing from the input keeps its last stored price
+    Prices of assets that are no longer configured are removed in the same transaction
     """
-    # Clear exisiting prices
-    db.query(models.LivePrice).delete()
-
-    # Bulk insert new prices
-    price_objects = [
-        models.LivePrice(asset=asset, price=price)
+    updated_at = datetime.datetime.now(datetime.timezone.utc)
+    records = [
+        {"asset": asset, "price": price, "updated_at": updated_at}
         for (asset, price) in price_data.items()
     ]
-    db.bulk_save_objects(price_objects)
-
+    bulk.upsert(db, models.LivePrice, records)
+    db.query(models.LivePrice).where(
+        models.LivePrice.asset.not_in(config.assets.keys())
+    ).delete(synchronize_session=False)
     db.commit()
 
 
 def store_historical_prices(db: Session, price_date: dict[str, dict[str, Decimal]]):
     """
-    Stores historical prices in the DB
+    Stores historical prices in the DB, overwriting any existing price on the same date
     Input is a mapping of asset -> date -> price
     """
-    price_objects = []
-    for asset, price_by_date in price_date.items():
-        for date, price in price_by_date.items():
-            price_objects.append(
-                models.HistoricalPrice(date=date, asset=asset, price=price)
+    records = [
+        {"asset": asset, "date": date, "price": price}
+        for asset, price_by_date in price_date.items()
+        for date, price in price_by_date.items()
+    ]
+    bulk.upsert(db, models.HistoricalPrice, records)
+    bump_data_version(db, models.HistoricalPrice.__tablename__)
+    db.commit()
+
+
+def _load_lots(db: Session, assets: list[str]) -> dict[str, list[dict]]:
+    """Loads the stored open lots for each asset in FIFO order"""
+    lots_by_asset: dict[str, list[dict]] = {asset: [] for asset in assets}
+    lots = (
+        db.query(models.OpenLot)
+        .where(models.OpenLot.asset.in_(assets))
+        .order_by(models.OpenLot.asset, models.OpenLot.sequence)
+    )
+    for lot in lots:
+        lots_by_asset[lot.asset].append(
+            {
+                "quantity": lot.quantity,
+                "price": lot.price,
+                "trade_id": lot.trade_id,
+                "date": lot.date,
+            }
+        )
+    return lots_by_asset
+
+
+def _replay_lots(db: Session, assets: list[str]) -> dict[str, list[dict]]:
+    """Rebuilds the open lots for each asset by replaying its full trade history"""
+    lots_by_asset: dict[str, list[dict]] = {asset: [] for asset in assets}
+    # The trades are upserted with Core statements that bypass the identity map, so any
+    # Trade objects already loaded in the session must be refreshed from the new rows
+    trades = (
+        db.query(models.Trade)
+        .where(models.Trade.asset.in_(assets))
+        .order_by(models.Trade.date, models.Trade.id)
+        .execution_options(populate_existing=True)
+    )
+    for trade in trades:
+        _apply_trade_to_lots(lots_by_asset[trade.asset], trade)
+    return lots_by_asset
+
+
+def _store_lots_and_positions(db: Session, lots_by_asset: dict[str, list[dict]]):
+    """Overwrites the open lots and current position for each of the provided assets"""
+    assets = list(lots_by_asset.keys())
+    if not assets:
+        return
+
+    db.query(models.OpenLot).where(models.OpenLot.asset.in_(assets)).delete()
+    db.query(models.Position).where(models.Position.asset.in_(assets)).delete()
+
+    for asset, buy_lots in lots_by_asset.items():
+        db.add_all(
+            models.OpenLot(
+                trade_id=lot["trade_id"],
+                asset=asset,
+                date=lot["date"],
+                sequence=sequence,
+                price=lot["price"],
+                quantity=lot["quantity"],
             )
+            for sequence, lot in enumerate(buy_lots)
+        )
 
-    db.bulk_save_objects(price_objects)
-    db.commit()
+        position = _position_from_lots(asset, buy_lots)
+        if position:
+            db.add(position)
 
 
-def store_positions(db: Session, positions: list[models.Position]):
-    """Stores the current position records, overwriting anything currently in the DB"""
+def rebuild_open_lots(db: Session):
+    """Rebuilds all open lots and current positions from the full trade history"""
+    db.query(models.OpenLot).delete()
     db.query(models.Position).delete()
-    db.bulk_save_objects(positions)
+    _store_lots_and_positions(db, _replay_lots(db, list(config.assets.keys())))
     db.commit()
 
 
-def store_historical_positions(
+def _trade_fingerprint(trade: models.Trade) -> tuple:
+    """The fields of a trade that determine its effect on the open lots"""
+    return (
+        trade.asset,
+        to_date(trade.date),
+        trade.action,
+        Decimal(trade.price).quantize(DECIMAL_PLACES),
+        Decimal(trade.quantity).quantize(DECIMAL_PLACES),
+        trade.excluded,
+    )
+
+
+def upsert_historical_positions(
     db: Session, historical_positions: list[models.HistoricalPosition]
 ):
-    """Stores historical positiosn in the DB"""
-    db.bulk_save_objects(historical_positions)
+    """Inserts historical positions, overwriting any existing snapshot for the same asset and date"""
+    bulk.upsert(db, models.HistoricalPosition, bulk.to_records(historical_positions))
+    bump_data_version(db, models.HistoricalPosition.__tablename__)
+
+
+def get_data_version(db: Session, name: str) -> int:
+    """Returns the current version of the named data (0 if it's never been written)"""
+    version = (
+        db.query(models.DataVersion.version)
+        .where(models.DataVersion.name == name)
+        .scalar()
+    )
+    return version or 0
+
+
+def bump_data_version(db: Session, name: str):
+    """
+    Increments the version of the named data, invalidating any cached reads of it
+    Nothing is committed, so the bump lands in the same transaction as the write
+    """
+    stmt = insert(models.DataVersion).values(
+        name=name,
+        version=1,
+        updated_at=datetime.datetime.now(datetime.timezone.utc),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["name"],
+        set_={
+            "version": models.DataVersion.version + 1,
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+    db.execute(stmt)
+
+
+def get_dirty_positions(db: Session) -> list[models.DirtyPosition]:
+    """Returns each asset that has out of date historical positions"""
+    return db.query(models.DirtyPosition).order_by(models.DirtyPosition.asset).all()
+
+
+def mark_positions_dirty(db: Session, dirty_dates: dict[str, datetime.date]):
+    """
+    Records the earliest date from which each asset's historical positions are stale
+    If the asset is already marked, the earlier of the two dates is kept
+    Input is a mapping of asset -> date
+    """
+    if not dirty_dates:
+        return
+
+    stmt = insert(models.DirtyPosition).values(
+        [{"asset": asset, "date": date} for (asset, date) in dirty_dates.items()]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["asset"],
+        set_={"date": func.least(models.DirtyPosition.date, stmt.excluded.date)},
+    )
+    db.execute(stmt)
+
+
+def recompute_historical_positions(
+    db: Session, asset: str, target_dates: list[str], dirty_date: datetime.date
+):
+    """
+    Rebuilds an asset's historical positions over the given date range, upserting the
+    new snapshots and removing any that no longer have a position
+    The asset's dirty marker is cleared as long as it wasn't moved earlier than
+    dirty_date in the meantime (dirty_date can precede the range if it starts before
+    the first snapshot)
+    """
+    start_date, end_date = min(target_dates), max(target_dates)
+    historical_positions = build_historical_positions(db, target_dates, assets=[asset])
+
+    upsert_historical_positions(db, historical_positions)
+
+    rebuilt_dates = {str(position.date) for position in historical_positions}
+    (
+        db.query(models.HistoricalPosition)
+        .where(models.HistoricalPosition.asset == asset)
+        .where(models.HistoricalPosition.date >= start_date)
+        .where(models.HistoricalPosition.date <= end_date)
+        .where(models.HistoricalPosition.date.not_in(rebuilt_dates))
+        .delete(synchronize_session=False)
+    )
+    (
+        db.query(models.DirtyPosition)
+        .where(models.DirtyPosition.asset == asset)
+        .where(models.DirtyPosition.date >= dirty_date)
+        .delete(synchronize_session=False)
+    )
     db.commit()
 
 
 def store_trades(db: Session, trades: list[models.Trade]):
-    """Stores trades in the DB"""
+    """
+    Stores trades in the DB and applies them to the open lots and current positions
+
+    New trades are applied directly on top of each asset's stored lots. If a trade
+    modifies an existing trade, or is not dated after the asset's latest trade, the FIFO
+    order could change, so that asset's lots are instead replayed from its full history
+
+    Any trade on or before the last historical position snapshot marks that asset's
+    snapshots as dirty from the trade date onwards
+    """
     if not trades:
         return
 
+    # Duplicate IDs are upserted into a single row, so only the last one takes effect
+    trades = list({trade.id: trade for trade in trades}.values())
+
+    # Snapshot the state of the trades table before writing
+    existing_trades = {
+        trade.id: _trade_fingerprint(trade)
+        for trade in db.query(models.Trade).where(
+            models.Trade.id.in_([trade.id for trade in trades])
+        )
+    }
+    last_trade_dates = dict(
+        db.query(models.Trade.asset, func.max(models.Trade.date))
+        .group_by(models.Trade.asset)
+        .all()
+    )
+    lots_initialized = db.query(models.OpenLot.trade_id).first() is not None
+    last_snapshot_date = db.query(func.max(models.HistoricalPosition.date)).scalar()
+
+    replay_assets = set()
+    new_trades = defaultdict(list)
+    dirty_dates: dict[str, datetime.date] = {}
     for trade in trades:
-        db.merge(trade)
+        previous = existing_trades.get(trade.id)
+        if previous == _trade_fingerprint(trade):
+            continue  # re-scraped trade with no changes
+
+        # Track the earliest date affected for each asset (including the trade's
+        # previous asset and date if it was modified)
+        affected = [(trade.asset, to_date(trade.date))]
+        if previous:
+            affected.append((previous[0], previous[1]))
+        for asset, date in affected:
+            if last_snapshot_date and date <= last_snapshot_date:
+                dirty_dates[asset] = min(date, dirty_dates.get(asset, date))
+
+        if previous:
+            replay_assets.update([previous[0], trade.asset])
+            continue
+
+        last_trade_date = last_trade_dates.get(trade.asset)
+        if last_trade_date and to_date(trade.date) <= last_trade_date:
+            replay_assets.add(trade.asset)
+        else:
+            new_trades[trade.asset].append(trade)
+
+    # If the lots have never been built, there's nothing to apply new trades on top of
+    if not lots_initialized:
+        replay_assets.update(config.assets.keys())
+
+    bulk.upsert(db, models.Trade, bulk.to_records(trades))
+    bump_data_version(db, models.Trade.__tablename__)
+
+    replay_assets &= set(config.assets.keys())
+    incremental_assets = [
+        asset
+        for asset in new_trades.keys()
+        if asset in config.assets.keys() and asset not in replay_assets
+    ]
+
+    lots_by_asset = _replay_lots(db, list(replay_assets))
+    for asset, buy_lots in _load_lots(db, incremental_assets).items():
+        for trade in sorted(new_trades[asset], key=lambda t: (to_date(t.date), t.id)):
+            _apply_trade_to_lots(buy_lots, trade)
+        lots_by_asset[asset] = buy_lots
+
+    _store_lots_and_positions(db, lots_by_asset)
+    mark_positions_dirty(
+        db,
+        {
+            asset: date
+            for (asset, date) in dirty_dates.items()
+            if asset in config.assets.keys()
+        },
+    )
     db.commit()
 
 
-def get_latest_asset_price(db: Session, asset: str, date: str) -> Decimal:
-    """Retrieves the latest price for the given asset before the specified date"""
-    previous_price = (
-        db.query(models.HistoricalPrice.price)
-        .filter(models.HistoricalPrice.asset == asset)
+def get_latest_asset_prices(
+    db: Session, date: str, assets: list[str] | None = None
+) -> dict[str, Decimal]:
+    """
+    Retrieves the latest price for each asset before the specified date in one query
+    Returns a mapping of asset -> price (assets without an earlier price are omitted)
+    """
+    query = (
+        db.query(models.HistoricalPrice.asset, models.HistoricalPrice.price)
         .filter(models.HistoricalPrice.date < date)
-        .order_by(models.HistoricalPrice.date.desc())
-        .first()
+        .distinct(models.HistoricalPrice.asset)
+        .order_by(models.HistoricalPrice.asset, models.HistoricalPrice.date.desc())
+    )
+    if assets:
+        query = query.filter(models.HistoricalPrice.asset.in_(assets))
+
+    return {asset: price for (asset, price) in query.all()}
+
+
+def get_stored_prices(
+    db: Session, start_date: str, end_date: str, assets: list[str] | None = None
+) -> dict[str, dict[str, Decimal]]:
+    """
+    Retrieves the stored historical prices between the two dates (inclusive)
+    Returns a mapping of asset -> date -> price
+    """
+    query = db.query(
+        models.HistoricalPrice.asset,
+        models.HistoricalPrice.date,
+        models.HistoricalPrice.price,
+    ).filter(
+        models.HistoricalPrice.date >= start_date,
+        models.HistoricalPrice.date <= end_date,
     )
+    if assets:
+        query = query.filter(models.HistoricalPrice.asset.in_(assets))
 
-    assert previous_price, f"No previous price found for {asset} before {date}"
-    return previous_price[0]
+    stored_prices: dict[str, dict[str, Decimal]] = defaultdict(dict)
+    for asset, date, price in query.all():
+        stored_prices[asset][str(date)] = price
+    return dict(stored_prices)
@@ -2,7 +2,7 @@ import datetime
 from decimal import Decimal
 from enum import Enum
 
-from sqlalchemy import DECIMAL, Date, DateTime, String, Boolean
+from sqlalchemy import DECIMAL, Date, DateTime, String, Boolean, Integer
 from sqlalchemy.orm import Mapped, mapped_column, declarative_base
 
 Base = declarative_base()
@@ -47,6 +47,22 @@ class Position(Base):
     cost: Mapped[Decimal] = mapped_column(decimal_sql_type, nullable=False)
 
 
+class OpenLot(Base):
+    """
+    Stores the unsold portion of each buy trade, which together form the FIFO queue
+    that the current positions are derived from
+    """
+
+    __tablename__ = "open_lots"
+
+    trade_id: Mapped[str] = mapped_column(String, primary_key=True)
+    asset: Mapped[str] = mapped_column(String, nullable=False, index=True)
+    date: Mapped[datetime.date] = mapped_column(Date, nullable=False)
+    sequence: Mapped[int] = mapped_column(Integer, nullable=False)
+    price: Mapped[Decimal] = mapped_column(decimal_sql_type, nullable=False)
+    quantity: Mapped[Decimal] = mapped_column(decimal_sql_type, nullable=False)
+
+
 class HistoricalPosition(Base):
     """Stores the historical position info for each date"""
 
@@ -64,6 +80,18 @@ class HistoricalPosition(Base):
     returns: Mapped[Decimal] = mapped_column(decimal_sql_type, nullable=False)
 
 
+class DirtyPosition(Base):
+    """
+    Tracks the earliest date from which each asset's historical position snapshots
+    are out of date, e.g. after a back-dated trade is stored
+    """
+
+    __tablename__ = "dirty_positions"
+
+    asset: Mapped[str] = mapped_column(String, primary_key=True)
+    date: Mapped[datetime.date] = mapped_column(Date, nullable=False)
+
+
 class HistoricalPrice(Base):
     """Stores daily historical close price for each asset"""
 
@@ -87,3 +115,33 @@ class LivePrice(Base):
         DateTime(timezone=True),
         default=lambda: datetime.datetime.now(datetime.timezone.utc),
     )
+
+
+class Checkpoint(Base):
+    """Records the progress of long running jobs that write in chunks, so they can be resumed"""
+
+    __tablename__ = "checkpoints"
+
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    start_date: Mapped[datetime.date] = mapped_column(Date, nullable=False)
+    end_date: Mapped[datetime.date] = mapped_column(Date, nullable=False)
+    last_date: Mapped[datetime.date | None] = mapped_column(Date, nullable=True)
+    updated_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=lambda: datetime.datetime.now(datetime.timezone.utc),
+        onupdate=lambda: datetime.datetime.now(datetime.timezone.utc),
+    )
+
+
+class DataVersion(Base):
+    """Counts the writes to a table, so that cached reads of it know when to invalidate"""
+
+    __tablename__ = "data_versions"
+
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    updated_at: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=lambda: datetime.datetime.now(datetime.timezone.utc),
+        onupdate=lambda: datetime.datetime.now(datetime.timezone.utc),
+    )
@@ -0,0 +1,122 @@
+import datetime
+from dataclasses import dataclass
+from decimal import Decimal, ROUND_HALF_UP
+from functools import cached_property
+from typing import Iterable
+import numpy as np
+
+# Matches the scale of the DECIMAL(18, 6) columns
+DECIMAL_PLACES = Decimal("0.000001")
+
+
+def to_date(date: str | datetime.date) -> datetime.date:
+    """Normalizes an ISO date string or date object to a date"""
+    if isinstance(date, datetime.date):
+        return date
+    return datetime.date.fromisoformat(date)
+
+
+@dataclass
+class PriceMatrix:
+    """
+    Dense asset x date grid of daily close prices for a date window
+    Each cell holds the latest known price on or before that date (i.e. it's forward filled),
+    or None if the asset has no price yet in the window
+    """
+
+    assets: list[str]
+    start_date: datetime.date
+    end_date: datetime.date
+    prices: np.ndarray  # object array of Decimal | None with shape (assets, dates)
+
+    @classmethod
+    def from_rows(
+        cls,
+        rows: Iterable[tuple[str, datetime.date, Decimal]],
+        start_date: str | datetime.date,
+        end_date: str | datetime.date,
+        previous_prices: dict[str, Decimal] | None = None,
+    ) -> "PriceMatrix":
+        """
+        Builds the matrix from (asset, date, price) rows that fall within the window
+        The forward fill is seeded with each asset's last price before the window, if given
+        """
+        start_date = to_date(start_date)
+        end_date = to_date(end_date)
+        num_dates = (end_date - start_date).days + 1
+        previous_prices = previous_prices or {}
+
+        rows = list(rows)
+        assets = sorted({asset for (asset, _, _) in rows} | previous_prices.keys())
+        asset_index = {asset: i for i, asset in enumerate(assets)}
+
+        prices = np.full((len(assets), max(num_dates, 0)), None, dtype=object)
+        for asset, date, price in rows:
+            if price is None:
+                continue
+            prices[asset_index[asset], (date - start_date).days] = price
+
+        # Forward fill each asset so that lookups are as-of the requested date
+        for asset, asset_prices in zip(assets, prices):
+            last_price = previous_prices.get(asset)
+            for i, price in enumerate(asset_prices):
+                if price is None:
+                    asset_prices[i] = last_price
+                else:
+                    last_price = price
+
+        return cls(
+            assets=assets, start_date=start_date, end_date=end_date, prices=prices
+        )
+
+    @cached_property
+    def float_prices(self) -> np.ndarray:
+        """The price matrix as a float array, with NaN where there is no price"""
+        float_prices = np.full(self.prices.shape, np.nan, dtype=np.float64)
+        has_price = self.prices != None  # noqa: E711 (elementwise comparison)
+        float_prices[has_price] = self.prices[has_price].astype(np.float64)
+        return float_prices
+
+    @cached_property
+    def asset_index(self) -> dict[str, int]:
+        """Mapping of asset -> row in the matrix"""
+        return {asset: i for i, asset in enumerate(self.assets)}
+
+    def date_index(self, date: str | datetime.date) -> int:
+        """Returns the column in the matrix for a given date"""
+        return (to_date(date) - self.start_date).days
+
+    def get_price(self, asset: str, date: str | datetime.date) -> Decimal | None:
+        """
+        Returns the latest price on or before the given date
+        Dates after the window resolve to the last date in the window, and
+        dates before the window (or unknown assets) return None
+        """
+        if asset not in self.asset_index:
+            return None
+
+        column = self.date_index(date)
+        if column < 0:
+            return None
+        column = min(column, self.prices.shape[1] - 1)
+
+        return self.prices[self.asset_index[asset], column]
+
+
+def value_positions(
+    prices: np.ndarray, quantities: np.ndarray, costs: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates the value and percentage returns for every (asset, date) cell at once
+    All arrays share the same shape; cells without a position should have zero cost
+    and will come back as NaN returns
+    """
+    values = quantities * prices
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = (values - costs) / costs * 100
+    return values, returns
+
+
+def to_decimal(value: float) -> Decimal:
+    """Converts a float result back to a decimal with the precision stored in the DB"""
+    return Decimal(repr(float(value))).quantize(DECIMAL_PLACES, rounding=ROUND_HALF_UP)
@@ -1,9 +1,12 @@
 import click
 import datetime
+import time
 import pandas as pd
+from concurrent.futures import Future, ThreadPoolExecutor
 from decimal import Decimal
 from backend.database import crud, models, connection
 from backend.scrapers import prices, trades
+from backend.scrapers.brokers import broker_clients
 from backend.config import config, logger
 from sqlalchemy.orm import Session
 from sqlalchemy import func
@@ -69,8 +72,58 @@ def _fill_historical_positions(db: Session):
     target_dates = _get_date_range(start_date=start_date, end_date=end_date)
     logger.info(f"Filling historical positions from {start_date} to {end_date}...")
 
-    historical_positions = crud.build_historical_positions(db, target_dates)
-    crud.store_historical_positions(db, historical_positions)
+    crud.backfill_historical_positions(db, target_dates)
+
+
+def _resume_historical_positions(db: Session):
+    """
+    Continues an interrupted historical positions backfill from the chunk after the
+    last one committed, up to the end date of the original run
+    If the backfill was run in parallel, each unfinished partition is resumed
+    """
+    checkpoints = crud.get_checkpoints(db, crud.HISTORICAL_POSITIONS_CHECKPOINT)
+    assert checkpoints, "No interrupted positions backfill to resume"
+
+    for checkpoint in checkpoints:
+        if checkpoint.last_date:
+            start_date = checkpoint.last_date + datetime.timedelta(days=1)
+        else:
+            start_date = checkpoint.start_date
+        end_date = checkpoint.end_date
+
+        target_dates = _get_date_range(start_date=start_date, end_date=end_date)
+        logger.info(f"Resuming {checkpoint.name} from {start_date} to {end_date}...")
+
+        crud.backfill_historical_positions(
+            db, target_dates, checkpoint_name=checkpoint.name
+        )
+
+
+def recompute_dirty_positions(db: Session):
+    """
+    Rebuilds the historical position snapshots of any asset that had trades stored
+    on or before the last snapshot, from the earliest affected date onwards
+    """
+    dirty_positions = crud.get_dirty_positions(db)
+    if not dirty_positions:
+        logger.info("No dirty positions")
+        return
+
+    first_snapshot_date, last_snapshot_date = db.query(
+        func.min(models.HistoricalPosition.date),
+        func.max(models.HistoricalPosition.date),
+    ).one()
+    assert last_snapshot_date, "No historical positions present, please seed DB first"
+
+    for dirty_position in dirty_positions:
+        start_date = max(dirty_position.date, first_snapshot_date)
+        target_dates = _get_date_range(start_date=start_date, end_date=last_snapshot_date)
+        logger.info(
+            f"Recomputing {dirty_position.asset} positions from {start_date} to {last_snapshot_date}..."
+        )
+        crud.recompute_historical_positions(
+            db, dirty_position.asset, target_dates, dirty_date=dirty_position.date
+        )
 
 
 def fill_prices_and_positions(db: Session):
@@ -82,11 +135,53 @@ def fill_prices_and_positions(db: Session):
     _fill_historical_prices(db)
     logger.info("Done")
 
+    logger.info("Recomputing dirty historical positions...")
+    recompute_dirty_positions(db)
+    logger.info("Done")
+
     logger.info("Filling historical positions...")
     _fill_historical_positions(db)
     logger.info("Done")
 
 
+def refresh_live_prices():
+    """
+    Refreshes the cached live prices once they're due, so request handlers only ever
+    read from the cache
+    Runs at the market hours cadence, skipping runs overnight and on weekends until
+    the slower off hours interval has passed
+    """
+    if not prices.live_price_cache.is_due():
+        return
+    logger.info("Refreshing live prices...")
+    prices.live_price_cache.refresh()
+    logger.info("Done")
+
+
+def keep_broker_sessions_alive():
+    """Tickles the broker sessions so they don't time out between syncs"""
+    broker_clients.keepalive()
+
+
+def _get_scraped_trades(
+    future: Future, trade_type: str, deadline: float
+) -> list[models.Trade]:
+    """
+    Waits for a trade scrape to finish by the deadline (in monotonic time)
+    If it fails or times out, the error is logged and no trades are returned, so the
+    other scrape's trades are still stored
+    """
+    try:
+        scraped_trades = future.result(timeout=max(deadline - time.monotonic(), 0))
+        logger.info(f"Found {len(scraped_trades)} {trade_type} trades")
+        return scraped_trades
+    except TimeoutError:
+        logger.error(f"Timed out scraping {trade_type} trades")
+    except Exception as e:
+        logger.error(f"Failed to scrape {trade_type} trades: {e}")
+    return []
+
+
 def index_recent_trades(db: Session):
     """
     Checks for any recent crypto or stock trades and saves them in the database
@@ -105,34 +200,41 @@ def index_recent_trades(db: Session):
         "No trades present, please seed DB first"
     )
 
-    try:
-        logger.info(f"Checking for stock trades since {last_ibkr_trade_date}...")
-        stock_trades = trades.get_recent_ibkr_trades(
-            db=db, start_date=last_ibkr_trade_date
-        )
-        logger.info(f"Found {len(stock_trades)} stock trades")
-    except Exception as e:
-        logger.error(f"Failed to scrape stock trades: {e}")
-        stock_trades = []
+    # The session can't be shared with the scraper threads, so the existing trades
+    # used for IBKR conflict checks are loaded here
+    trade_index = trades.get_trade_index(db, last_ibkr_trade_date)
+
+    # The brokers are independent, so both are scraped at once, each with its own timeout
+    logger.info(f"Checking for stock trades since {last_ibkr_trade_date}...")
+    logger.info(f"Checking for crypto trades since {last_coinbase_trade_date}...")
+    deadline = time.monotonic() + config.trade_scrape_timeout_sec
+    executor = ThreadPoolExecutor(max_workers=2)
+    stock_future = executor.submit(
+        trades.get_recent_ibkr_trades, last_ibkr_trade_date, trade_index
+    )
+    crypto_future = executor.submit(
+        trades.get_recent_coinbase_trades, last_coinbase_trade_date
+    )
+    # Don't block on a scrape that times out - it's left to finish in the background
+    executor.shutdown(wait=False)
 
-    try:
-        logger.info(f"Checking for crypto trades since {last_coinbase_trade_date}...")
-        crypto_trades = trades.get_recent_coinbase_trades(
-            start_date=last_coinbase_trade_date
-        )
-        logger.info(f"Found {len(crypto_trades)} crypto trades")
-    except Exception as e:
-        logger.error(f"Failed to scrape crypto trades: {e}")
-        crypto_trades = []
+    stock_trades = _get_scraped_trades(stock_future, "stock", deadline)
+    crypto_trades = _get_scraped_trades(crypto_future, "crypto", deadline)
 
-    logger.info("Writing trades to DB")
+    logger.info("Writing trades to DB and updating current position")
     all_trades = stock_trades + crypto_trades
     crud.store_trades(db, all_trades)
 
-    logger.info("Updating current position")
-    positions = crud.build_positions_from_trades(db)
-    crud.store_positions(db, positions)
+    logger.info("Done")
 
+
+def rebuild_open_lots(db: Session):
+    """
+    Rebuilds the open lots and current positions from the full trade history
+    Only needed to initialize the lots, since they're kept up to date as trades are stored
+    """
+    logger.info("Rebuilding open lots...")
+    crud.rebuild_open_lots(db)
     logger.info("Done")
 
 
@@ -181,10 +283,6 @@ def index_backdoor_roth_trades(db: Session):
 
     logger.info(f"Inserting {len(trade_objects)} backdoor roth trades (vanguard-{next_id - len(trade_objects)} to vanguard-{next_id - 1})")
     crud.store_trades(db, trade_objects)
-
-    logger.info("Updating current position")
-    positions = crud.build_positions_from_trades(db)
-    crud.store_positions(db, positions)
     logger.info("Done")
 
 
@@ -192,17 +290,37 @@ def index_backdoor_roth_trades(db: Session):
 @click.option("--trades", "run_trades", is_flag=True, help="Index recent trades")
 @click.option("--prices", "run_prices", is_flag=True, help="Fill historical prices")
 @click.option("--positions", "run_positions", is_flag=True, help="Fill historical positions")
+@click.option("--resume", is_flag=True, help="Resume an interrupted positions backfill (with --positions)")
 @click.option("--backdoor-roth", "run_backdoor_roth", is_flag=True, help="Index backdoor roth trades from CSVs")
-def main(run_trades: bool, run_prices: bool, run_positions: bool, run_backdoor_roth: bool):
+@click.option("--lots", "run_lots", is_flag=True, help="Rebuild open lots and positions from all trades")
+@click.option("--recompute", "run_recompute", is_flag=True, help="Recompute historical positions after back-dated trades")
+def main(
+    run_trades: bool,
+    run_prices: bool,
+    run_positions: bool,
+    resume: bool,
+    run_backdoor_roth: bool,
+    run_lots: bool,
+    run_recompute: bool,
+):
+    # Create any tables that were added since the DB was seeded
+    models.Base.metadata.create_all(connection.engine)
+
     with connection.SessionLocal() as db:
+        if run_lots:
+            rebuild_open_lots(db)
         if run_trades:
             index_recent_trades(db)
         if run_prices:
             _fill_historical_prices(db)
-        if run_positions:
+        if run_positions and resume:
+            _resume_historical_positions(db)
+        elif run_positions:
             _fill_historical_positions(db)
         if run_backdoor_roth:
             index_backdoor_roth_trades(db)
+        if run_recompute:
+            recompute_dirty_positions(db)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,6 @@
+import datetime
 from apscheduler.schedulers.asyncio import AsyncIOScheduler  # type: ignore
+from backend.config import config
 from backend.jobs import jobs
 from backend.database import connection
 
@@ -11,9 +13,26 @@ def get_scheduler() -> AsyncIOScheduler:
      - Fill previous historical prices every day at 5am CST
      - Fill previous historical positions every day at 5am CST
      - Index recent trades every 10 minutes
+     - Refresh live prices every few minutes during market hours (less often otherwise)
+     - Keep the broker sessions alive every minute
     """
     scheduler = AsyncIOScheduler()
     with connection.SessionLocal() as db:
         scheduler.add_job(jobs.fill_prices_and_positions, "cron", args=[db], hour=5, minute=0, timezone=TIMEZONE)
         scheduler.add_job(jobs.index_recent_trades, "cron", args=[db], hour="7", minute=0, timezone=TIMEZONE)
+    scheduler.add_job(
+        jobs.refresh_live_prices,
+        "interval",
+        minutes=config.live_price_refresh_market_min,
+        next_run_time=datetime.datetime.now(),
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        jobs.keep_broker_sessions_alive,
+        "interval",
+        seconds=config.broker_keepalive_sec,
+        max_instances=1,
+        coalesce=True,
+    )
     return scheduler
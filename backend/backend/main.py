@@ -1,4 +1,7 @@
 from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
+from backend.config import config
+from backend.database import connection, models
 from backend.jobs import schedules
 from backend.router import routes
 from contextlib import asynccontextmanager
@@ -7,12 +10,18 @@ from contextlib import asynccontextmanager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Controls the app startup and shutdown with scheduled jobs"""
+    models.Base.metadata.create_all(connection.engine)  # adds any new tables
+
     scheduler = schedules.get_scheduler()
     scheduler.start()
     yield  # main app flow
     scheduler.shutdown()
+    await connection.async_engine.dispose()
 
 
 app = FastAPI(title="Portfolio Tracker", lifespan=lifespan)
 
+# Compress large responses (e.g. long performance and price histories)
+app.add_middleware(GZipMiddleware, minimum_size=config.gzip_minimum_size)
+
 app.include_router(routes.router)
@@ -0,0 +1,41 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class VersionedCache(Generic[T]):
+    """
+    In-process LRU cache of computed responses, tagged with the version of the data
+    they were built from
+    Once a newer data version is seen every entry is dropped, so writes are never
+    hidden by the cache
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.version: int | None = None
+        self.entries: OrderedDict[Hashable, T] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, version: int, key: Hashable, build: Callable[[], T]) -> T:
+        """Returns the cached value for the key at this version, building it on a miss"""
+        with self.lock:
+            if self.version is None or version > self.version:
+                self.entries.clear()
+                self.version = version
+            elif version == self.version and key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        value = build()
+
+        with self.lock:
+            # Skip caching if the data moved on while building
+            if version == self.version:
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return value
@@ -1,8 +1,12 @@
 import datetime
-from fastapi import APIRouter, Request, HTTPException, Depends
+from fastapi import APIRouter, Request, Response, HTTPException, Depends
 from fastapi.security import HTTPAuthorizationCredentials
 from fastapi import Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from pydantic import BaseModel
 from backend.database import connection, crud
 from backend.config import config, VALID_DURATIONS
 from backend.router import transforms
@@ -22,6 +26,37 @@ def verify_token(request: Request):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+def is_not_modified(request: Request, response: Response, etag: str) -> bool:
+    """
+    Sets the ETag on the response, and checks the request's If-None-Match header to see
+    whether the client already has the current version
+    Clients are asked to always revalidate, so a 304 is only sent when nothing has changed
+    If-None-Match uses the weak comparison, so the W/ prefix is ignored on both sides
+    """
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+def not_modified_response(response: Response) -> Response:
+    """Returns an empty 304 response, keeping the caching headers"""
+    return Response(status_code=304, headers=dict(response.headers))
+
+
+def columnar_response(response: Response, columns: BaseModel) -> ORJSONResponse:
+    """
+    Renders a columnar payload with orjson, skipping FastAPI's response encoding
+    The caching headers are copied over, since they're not applied to returned responses
+    """
+    return ORJSONResponse(columns.model_dump(), headers=dict(response.headers))
+
+
 @router.get("/status")
 def health_check():
     return "ok"
@@ -33,38 +68,57 @@ def authenticate(_: HTTPAuthorizationCredentials = Depends(verify_token)):
 
 
 @router.get("/trades")
-async def get_trades(_: HTTPAuthorizationCredentials = Depends(verify_token), db: Session = Depends(connection.get_db)):
+async def get_trades(
+    request: Request,
+    response: Response,
+    _: HTTPAuthorizationCredentials = Depends(verify_token),
+    db: AsyncSession = Depends(connection.get_async_db),
+):
     """Returns all trades"""
-    return crud.get_trades(db)
+    etag = await db.run_sync(transforms.get_trades_etag)
+    if is_not_modified(request, response, etag):
+        return not_modified_response(response)
+
+    return await db.run_sync(crud.get_trades)
 
 
 @router.get("/trades/{asset}")
 async def get_trades_by_asset(
     asset: str,
+    request: Request,
+    response: Response,
     _: HTTPAuthorizationCredentials = Depends(verify_token),
-    db: Session = Depends(connection.get_db),
+    db: AsyncSession = Depends(connection.get_async_db),
 ):
     """Returns all trades for the given asset"""
     if asset not in config.assets.keys():
         return HTTPException(status_code=400, detail=f"Invalid asset, must be one of {','.join(config.assets.keys())}")
 
-    return crud.get_trades(db, asset=asset)
+    etag = await db.run_sync(transforms.get_trades_etag, asset=asset)
+    if is_not_modified(request, response, etag):
+        return not_modified_response(response)
+
+    return await db.run_sync(crud.get_trades, asset=asset)
 
 
 @router.get("/positions")
 async def get_positions(
-    _: HTTPAuthorizationCredentials = Depends(verify_token), db: Session = Depends(connection.get_db)
+    _: HTTPAuthorizationCredentials = Depends(verify_token), db: AsyncSession = Depends(connection.get_async_db)
 ):
     """Returns all trades"""
-    return transforms.get_enriched_positions(db)
+    return await db.run_sync(transforms.get_enriched_positions)
 
 
 @router.get("/performance/{duration}")
 async def get_performance(
     duration: str,
+    request: Request,
+    response: Response,
     assets: str | None = Query(None, description="Comma-separated list of asset symbols"),
+    columnar: bool = Query(False, description="Return parallel arrays instead of a list of objects"),
+    max_points: int | None = Query(None, ge=3, description="Downsample to at most this many points"),
     _: HTTPAuthorizationCredentials = Depends(verify_token),
-    db: Session = Depends(connection.get_db),
+    db: AsyncSession = Depends(connection.get_async_db),
 ):
     """Returns the historical performance of the portfolio over time"""
     if duration not in VALID_DURATIONS:
@@ -78,20 +132,46 @@ async def get_performance(
             status_code=400, detail=f"Invalid asset(s), must be one of {','.join(config.assets.keys())}"
         )
 
-    return transforms.get_performance(db, duration=duration, assets=asset_list)
+    etag = await db.run_sync(
+        transforms.get_performance_etag, duration=duration, assets=asset_list, columnar=columnar, max_points=max_points
+    )
+    if is_not_modified(request, response, etag):
+        return not_modified_response(response)
+
+    performance = await db.run_sync(
+        transforms.get_cached_performance,
+        duration=duration,
+        assets=asset_list,
+        columnar=columnar,
+        max_points=max_points,
+    )
+    if columnar:
+        return columnar_response(response, performance)
+    return performance
 
 
 @router.get("/prices/{asset}")
 async def get_prices_by_asset(
     asset: str,
+    request: Request,
+    response: Response,
+    columnar: bool = Query(False, description="Return parallel arrays instead of a list of objects"),
+    max_points: int | None = Query(None, ge=3, description="Downsample to at most this many points"),
     _: HTTPAuthorizationCredentials = Depends(verify_token),
-    db: Session = Depends(connection.get_db),
+    db: AsyncSession = Depends(connection.get_async_db),
 ):
     """Returns the historical price data for the given asset"""
     if asset not in config.assets.keys():
         return HTTPException(status_code=400, detail=f"Invalid asset, must be one of {','.join(config.assets.keys())}")
 
-    return transforms.get_asset_prices(db, asset=asset)
+    etag = await db.run_sync(transforms.get_asset_prices_etag, asset=asset, columnar=columnar, max_points=max_points)
+    if is_not_modified(request, response, etag):
+        return not_modified_response(response)
+
+    if columnar:
+        columns = await db.run_sync(transforms.get_asset_prices_columns, asset=asset, max_points=max_points)
+        return columnar_response(response, columns)
+    return await db.run_sync(transforms.get_asset_prices, asset=asset, max_points=max_points)
 
 
 @router.post("/sync")
@@ -105,7 +185,8 @@ async def sync_trades(
         return {"status": "failed", "error": "rate limit exceeded"}
 
     try:
-        jobs.index_recent_trades(db)
+        # Scraping and storing trades is blocking, so it runs off the event loop
+        await run_in_threadpool(jobs.index_recent_trades, db)
         _last_indexed_trades = datetime.datetime.now()
         return {"status": "success"}
 
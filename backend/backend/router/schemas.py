@@ -34,6 +34,18 @@ class Performance(BaseModel):
     returns: Decimal
 
 
+class PerformanceColumns(BaseModel):
+    """
+    Defines the columnar schema for the /performance API response, with parallel arrays
+    for each field instead of an object per point in time
+    """
+
+    dates: list[str]
+    cost: list[float]
+    value: list[float]
+    returns: list[float]
+
+
 class HistoricalPrice(BaseModel):
     """
     Defines the schema for individual historical price entries.
@@ -52,3 +64,15 @@ class AssetPriceHistory(BaseModel):
     live_price: Decimal
     updated_at: datetime.datetime
     historical_prices: list[HistoricalPrice]
+
+
+class AssetPriceColumns(BaseModel):
+    """
+    Defines the columnar schema for the /prices API response, with parallel arrays
+    of the historical dates and prices
+    """
+
+    live_price: float
+    updated_at: datetime.datetime
+    dates: list[str]
+    prices: list[float]
@@ -1,12 +1,30 @@
 import datetime
+import hashlib
 from decimal import Decimal
+from typing import Sequence
+import numpy as np
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 from backend.database import crud, models
 from backend.scrapers import prices
 from backend.router import schemas
+from backend.router.cache import VersionedCache
 from backend.config import config, DURATION_TO_TIMEDELTA
 
+# Performance results only change when the historical positions are written
+performance_cache: VersionedCache[list[schemas.Performance] | schemas.PerformanceColumns] = VersionedCache(
+    max_size=config.performance_cache_size
+)
+
+
+def make_etag(*parts) -> str:
+    """
+    Builds a weak ETag from the values that identify the version of a response's data
+    It's weak because the same tag is sent on the gzip encoded and uncompressed bodies
+    """
+    digest = hashlib.sha256("|".join(str(part) for part in parts).encode()).hexdigest()
+    return f'W/"{digest[:32]}"'
+
 
 def get_enriched_positions(db: Session) -> list[schemas.Position]:
     """
@@ -49,8 +67,47 @@ def get_enriched_positions(db: Session) -> list[schemas.Position]:
     return enriched_positions
 
 
-def get_performance(db: Session, duration: str, assets: list[str]) -> list[schemas.Performance]:
-    """Returns the historical performance of the portfolio over time"""
+def _get_downsampled_indices(dates: Sequence[datetime.date], values: Sequence, max_points: int | None) -> list[int]:
+    """
+    Picks the indices of at most max_points points that preserve the shape of the series,
+    using Largest-Triangle-Three-Buckets
+    The first and last points are always kept, and every point is kept if there are few enough
+    """
+    num_points = len(values)
+    if max_points is None or num_points <= max_points or max_points < 3:
+        return list(range(num_points))
+
+    x = np.array([date.toordinal() for date in dates], dtype=np.float64)
+    y = np.array(values, dtype=np.float64)
+
+    # The points between the first and last are split into equal sized buckets, and from
+    # each bucket we keep the point forming the largest triangle with the previously kept
+    # point and the average of the next bucket
+    edges = np.linspace(1, num_points - 1, max_points - 1).astype(int)
+    indices = [0]
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x, next_y = x[end : edges[i + 2]].mean(), y[end : edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+
+        previous = indices[-1]
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        indices.append(start + int(np.argmax(areas)))
+
+    indices.append(num_points - 1)
+    return indices
+
+
+def _get_performance_snapshots(db: Session, duration: str, assets: list[str], max_points: int | None = None):
+    """
+    Returns the total cost and value of the positions on each date in the duration
+    With max_points, the snapshots are downsampled to at most that many, preserving the value's shape
+    """
     current_date = datetime.date.today()
 
     start_date = None
@@ -72,7 +129,18 @@ def get_performance(db: Session, duration: str, assets: list[str]) -> list[schem
         query = query.where(models.HistoricalPosition.date >= start_date)
 
     query = query.group_by(models.HistoricalPosition.date).order_by(models.HistoricalPosition.date)
+    snapshots = query.all()
 
+    indices = _get_downsampled_indices(
+        [snapshot.date for snapshot in snapshots], [snapshot.total_value for snapshot in snapshots], max_points
+    )
+    return [snapshots[i] for i in indices]
+
+
+def get_performance(
+    db: Session, duration: str, assets: list[str], max_points: int | None = None
+) -> list[schemas.Performance]:
+    """Returns the historical performance of the portfolio over time, optionally downsampled"""
     return [
         schemas.Performance(
             date=str(snapshot.date),
@@ -80,17 +148,116 @@ def get_performance(db: Session, duration: str, assets: list[str]) -> list[schem
             value=snapshot.total_value,
             returns=((snapshot.total_value - snapshot.total_cost) / snapshot.total_cost) * 100,
         )
-        for snapshot in query.all()
+        for snapshot in _get_performance_snapshots(db, duration, assets, max_points)
     ]
 
 
-def get_asset_prices(db: Session, asset: str) -> schemas.AssetPriceHistory:
-    """Returns the historical price history of the asset"""
+def get_performance_columns(
+    db: Session, duration: str, assets: list[str], max_points: int | None = None
+) -> schemas.PerformanceColumns:
+    """
+    Returns the historical performance of the portfolio over time as parallel arrays, optionally downsampled
+    The values are floats rather than decimals, since this shape is meant for fast serialization
+    """
+    snapshots = _get_performance_snapshots(db, duration, assets, max_points)
+    costs = [float(snapshot.total_cost) for snapshot in snapshots]
+    values = [float(snapshot.total_value) for snapshot in snapshots]
+
+    # Built with model_construct since the columns are already the right types
+    return schemas.PerformanceColumns.model_construct(
+        dates=[str(snapshot.date) for snapshot in snapshots],
+        cost=costs,
+        value=values,
+        returns=[(value - cost) / cost * 100 for (cost, value) in zip(costs, values)],
+    )
+
+
+def get_cached_performance(
+    db: Session, duration: str, assets: list[str], columnar: bool = False, max_points: int | None = None
+) -> list[schemas.Performance] | schemas.PerformanceColumns:
+    """
+    Returns the historical performance of the portfolio over time, served from memory
+    until the historical positions are next written
+    """
+    version = crud.get_data_version(db, models.HistoricalPosition.__tablename__)
+
+    # The duration windows are relative to today, so a new day needs a fresh result too
+    key = (duration, tuple(sorted(assets)), datetime.date.today(), columnar, max_points)
+    build_performance = get_performance_columns if columnar else get_performance
+    return performance_cache.get(version, key, lambda: build_performance(db, duration, assets, max_points))
+
+
+def _downsample_prices(historical_prices: list, max_points: int | None) -> list:
+    """Downsamples the historical prices to at most max_points, preserving the shape of the price"""
+    dates = [p.date for p in historical_prices]
+    indices = _get_downsampled_indices(dates, [p.price for p in historical_prices], max_points)
+    return [historical_prices[i] for i in indices]
+
+
+def get_asset_prices(db: Session, asset: str, max_points: int | None = None) -> schemas.AssetPriceHistory:
+    """Returns the historical price history of the asset, optionally downsampled"""
     live_price, updated_at = crud.get_live_price(db, asset)
-    historical_prices = crud.get_historical_prices(db, asset)
+    historical_prices = _downsample_prices(crud.get_historical_prices(db, asset).all(), max_points)
 
     return schemas.AssetPriceHistory(
         live_price=live_price,
         updated_at=updated_at,
         historical_prices=[schemas.HistoricalPrice(date=str(p.date), price=p.price) for p in historical_prices],
     )
+
+
+def get_asset_prices_columns(db: Session, asset: str, max_points: int | None = None) -> schemas.AssetPriceColumns:
+    """
+    Returns the historical price history of the asset as parallel arrays of dates and prices,
+    optionally downsampled
+    """
+    live_price, updated_at = crud.get_live_price(db, asset)
+    # Only the two columns are loaded, skipping the ORM objects
+    historical_prices = (
+        crud.get_historical_prices(db, asset)
+        .with_entities(models.HistoricalPrice.date, models.HistoricalPrice.price)
+        .all()
+    )
+    historical_prices = _downsample_prices(historical_prices, max_points)
+
+    return schemas.AssetPriceColumns.model_construct(
+        live_price=float(live_price),
+        updated_at=updated_at,
+        dates=[str(p.date) for p in historical_prices],
+        prices=[float(p.price) for p in historical_prices],
+    )
+
+
+def get_trades_etag(db: Session, asset: str | None = None) -> str:
+    """
+    Returns the ETag of the trades, which changes whenever trades are stored
+    The count and last date also cover trades written outside of store_trades (e.g. seeding)
+    """
+    query = db.query(func.count(models.Trade.id), func.max(models.Trade.date))
+    if asset:
+        query = query.where(models.Trade.asset == asset)
+    count, last_date = query.one()
+
+    version = crud.get_data_version(db, models.Trade.__tablename__)
+    return make_etag("trades", asset, version, count, last_date)
+
+
+def get_performance_etag(
+    db: Session, duration: str, assets: list[str], columnar: bool = False, max_points: int | None = None
+) -> str:
+    """Returns the ETag of the performance, which changes whenever historical positions are written"""
+    version = crud.get_data_version(db, models.HistoricalPosition.__tablename__)
+    return make_etag("performance", duration, sorted(assets), datetime.date.today(), columnar, max_points, version)
+
+
+def get_asset_prices_etag(db: Session, asset: str, columnar: bool = False, max_points: int | None = None) -> str:
+    """Returns the ETag of the asset's price history, which changes with each live or historical price update"""
+    _, updated_at = crud.get_live_price(db, asset)
+    count, last_date = (
+        db.query(func.count(models.HistoricalPrice.date), func.max(models.HistoricalPrice.date))
+        .where(models.HistoricalPrice.asset == asset)
+        .one()
+    )
+
+    version = crud.get_data_version(db, models.HistoricalPrice.__tablename__)
+    return make_etag("prices", asset, columnar, max_points, updated_at.isoformat(), version, count, last_date)
@@ -0,0 +1,71 @@
+import threading
+from coinbase.rest import RESTClient
+from ibind import IbkrClient
+from backend.config import config, logger
+
+
+class BrokerClients:
+    """
+    Process-wide registry of broker API clients
+    Each client is created once and reused, so syncs don't repeat the OAuth setup and
+    initial tickle. The IBKR session is kept alive by a periodic keepalive, and the
+    client is only rebuilt once its authentication has expired
+    """
+
+    def __init__(self):
+        self.ibkr: IbkrClient | None = None
+        self.coinbase: RESTClient | None = None
+        self.lock = threading.Lock()
+
+    def get_ibkr(self) -> IbkrClient:
+        """Returns the shared IBKR client, creating (and authenticating) it if needed"""
+        with self.lock:
+            if self.ibkr is None:
+                client = IbkrClient(**config.ibind_client_params)
+                client.tickle()
+                self.ibkr = client
+            return self.ibkr
+
+    def get_coinbase(self) -> RESTClient:
+        """Returns the shared Coinbase client, creating it if needed"""
+        with self.lock:
+            if self.coinbase is None:
+                self.coinbase = RESTClient(
+                    api_key=config.coinbase_api_key,
+                    api_secret=config.coinbase_api_secret,
+                )
+            return self.coinbase
+
+    def keepalive(self):
+        """
+        Tickles the IBKR session so it doesn't time out
+        If the session is no longer authenticated, the client is dropped so the next call
+        rebuilds it. Coinbase requests are signed individually, so there's no session
+        """
+        with self.lock:
+            client = self.ibkr
+        if client is None:
+            return
+
+        try:
+            healthy = client.check_health()
+        except AttributeError as e:
+            logger.error(f"Invalid IBKR health check response: {e}")
+            healthy = False
+
+        if healthy:
+            return
+
+        logger.warning("IBKR session is no longer authenticated, rebuilding client")
+        with self.lock:
+            # Another thread may have already replaced the client
+            if self.ibkr is not client:
+                return
+            self.ibkr = None
+        try:
+            client.close()
+        except Exception as e:
+            logger.error(f"Failed to close IBKR client: {e}")
+
+
+broker_clients = BrokerClients()
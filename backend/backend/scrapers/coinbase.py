@@ -1,13 +1,13 @@
-from coinbase.rest import RESTClient
 from backend.config import config
 from backend.database import models
+from backend.scrapers.brokers import broker_clients
 from datetime import datetime
 from decimal import Decimal
 
 
 def get_current_holdings() -> list[models.Position]:
     """Retrieves current coinbase holdings"""
-    client = RESTClient(api_key=config.coinbase_api_key, api_secret=config.coinbase_api_secret)
+    client = broker_clients.get_coinbase()
 
     portfolio = client.get_portfolio_breakdown(config.coinbase_account_id).to_dict()
 
@@ -1,15 +1,14 @@
 import click
-from ibind import IbkrClient
 from backend.config import config
 from backend.database import models
+from backend.scrapers.brokers import broker_clients
 from datetime import datetime
 from decimal import Decimal
 
 
 def get_current_holdings() -> list[models.Position]:
     """Retrieves current IBKR holdings"""
-    client = IbkrClient(**config.ibind_client_params)
-    client.tickle()
+    client = broker_clients.get_ibkr()
     positions_data = client.positions2(config.ibkr_account_id)
     assert positions_data.data, "No positions found for account"
 
@@ -43,7 +42,7 @@ def get_current_holdings() -> list[models.Position]:
 
 def get_contract_id(asset: str):
     """Returns the contract ID from an asset"""
-    client = IbkrClient(**config.ibind_client_params)
+    client = broker_clients.get_ibkr()
     print(f"{asset} Contract ID:", client.stock_conid_by_symbol(asset).data)  # type: ignore
 
 
@@ -1,9 +1,21 @@
 import datetime
+import threading
+from zoneinfo import ZoneInfo
+from concurrent.futures import Future, ThreadPoolExecutor
 from decimal import Decimal
-import requests
+from typing import Any
+import pandas as pd
 from sqlalchemy.orm import Session
-from backend.config import config, InvalidPriceResponse
-from backend.database import models, crud
+from backend.config import (
+    config,
+    logger,
+    InvalidPriceResponse,
+    MARKET_TIMEZONE,
+    MARKET_OPEN,
+    MARKET_CLOSE,
+)
+from backend.database import connection, models, crud
+from backend.scrapers import providers
 
 
 def _get_coingecko_headers() -> dict[str, str]:
@@ -25,25 +37,39 @@ def _get_previous_stock_price(
     For weekends and holidays, a price will not be found, and the returning dict will be missing
     that price key
     """
-    headers = {"Authorization": f"Token {config.tilingo_api_token}"}
-    params = {"startDate": min(target_dates), "endDate": max(target_dates)}
-
-    response = requests.get(
-        config.tilingo_prev_close_api.format(asset), params=params, headers=headers
+    start_date, end_date = min(target_dates), max(target_dates)
+    cached_data = providers.response_cache.get(
+        providers.tiingo.source, asset, start_date, end_date
     )
-    response_data: list = response.json()
+    if cached_data is not None:
+        response_data = cached_data
+    else:
+        headers = {"Authorization": f"Token {config.tilingo_api_token}"}
+        params = {"startDate": start_date, "endDate": end_date}
+        response_data = providers.tiingo.get_json(
+            config.tilingo_prev_close_api.format(asset),
+            price_type="previous",
+            params=params,
+            headers=headers,
+        )
 
     if not isinstance(response_data, list):
         raise InvalidPriceResponse(
             price_type="previous", source="Tiingo", response_data=response_data
         )
 
-    return {
+    prices = {
         entry["date"][:10]: Decimal(str(entry["close"]))
         for entry in response_data
         if entry["date"][:10] in target_dates
     }
 
+    if cached_data is None:
+        providers.response_cache.set(
+            providers.tiingo.source, asset, start_date, end_date, response_data
+        )
+    return prices
+
 
 def _get_previous_crypto_price(
     asset: str, target_dates: list[str]
@@ -65,16 +91,24 @@ def _get_previous_crypto_price(
     utc_tz = datetime.timezone.utc
     date_to_unix = {date: _close_date_to_unix(date) for date in target_dates}
 
-    headers = _get_coingecko_headers()
-    params = {"vs_currency": "usd", "days": len(target_dates) + 1, "interval": "daily"}
-    coingecko_id = config.coingecko_ids[asset]
-
-    response = requests.get(
-        config.coingecko_prev_close_api.format(coingecko_id),
-        params=params,
-        headers=headers,
+    start_date, end_date = min(target_dates), max(target_dates)
+    cached_data = providers.response_cache.get(
+        providers.coingecko.source, asset, start_date, end_date
     )
-    response_data: dict = response.json()
+    if cached_data is not None:
+        response_data = cached_data
+    else:
+        # The chart covers the days up to now, so it has to reach back to the start date
+        days = (datetime.date.today() - datetime.date.fromisoformat(start_date)).days
+        headers = _get_coingecko_headers()
+        params = {"vs_currency": "usd", "days": days + 1, "interval": "daily"}
+        coingecko_id = config.coingecko_ids[asset]
+        response_data = providers.coingecko.get_json(
+            config.coingecko_prev_close_api.format(coingecko_id),
+            price_type="previous",
+            params=params,
+            headers=headers,
+        )
 
     if "prices" not in response_data:
         raise InvalidPriceResponse(
@@ -84,16 +118,23 @@ def _get_previous_crypto_price(
     price_data = response_data["prices"]
     price_by_unix_date = {time_unix: str(price) for (time_unix, price) in price_data}
 
-    return {
+    prices = {
         date: Decimal(price_by_unix_date[date_to_unix[date]]) for date in target_dates
     }
 
+    if cached_data is None:
+        providers.response_cache.set(
+            providers.coingecko.source, asset, start_date, end_date, response_data
+        )
+    return prices
+
 
 def _get_current_stock_price(asset: str) -> Decimal:
     """Gets the current market price for a stock or ETF"""
     params = {"symbol": asset, "token": config.finhub_api_token}
-    response = requests.get(config.finhub_live_price_api, params=params)
-    response_data: dict = response.json()
+    response_data: dict = providers.finhub.get_json(
+        config.finhub_live_price_api, price_type="current", params=params
+    )
 
     if "c" not in response_data:
         raise InvalidPriceResponse(
@@ -103,20 +144,17 @@ def _get_current_stock_price(asset: str) -> Decimal:
     return Decimal(str(response_data["c"]))
 
 
-def _get_current_stock_prices() -> dict[str, Decimal]:
-    """Gets the current market price for each stock or ETF"""
-    return {asset: _get_current_stock_price(asset) for asset in config.stock_tickers}
-
-
 def _get_current_crypto_prices() -> dict[str, Decimal]:
     """Gets the current market price for each crypt token"""
     headers = _get_coingecko_headers()
     params = {"ids": ",".join(config.coingecko_ids.values()), "vs_currencies": "usd"}
 
-    response = requests.get(
-        config.coingecko_live_price_api, params=params, headers=headers
+    response_data: dict = providers.coingecko.get_json(
+        config.coingecko_live_price_api,
+        price_type="current",
+        params=params,
+        headers=headers,
     )
-    response_data: dict = response.json()
 
     if not all(
         config.coingecko_ids[asset] in response_data for asset in config.crypto_tokens
@@ -131,64 +169,330 @@ def _get_current_crypto_prices() -> dict[str, Decimal]:
     }
 
 
+def _get_missing_windows(
+    target_dates: list[str], stored_dates: set[str], is_stock: bool
+) -> list[list[str]]:
+    """
+    Groups the target dates without a stored price into runs of consecutive days, so
+    each run can be fetched with a single request
+    Stock runs that only cover a weekend are skipped, since there are no closes to
+    fetch (those dates are forward filled instead)
+    """
+    windows: list[list[str]] = []
+    for date in sorted(target_dates):
+        if date in stored_dates:
+            continue
+        previous_date = datetime.date.fromisoformat(date) - datetime.timedelta(days=1)
+        if windows and windows[-1][-1] == str(previous_date):
+            windows[-1].append(date)
+        else:
+            windows.append([date])
+
+    if is_stock:
+        windows = [
+            window
+            for window in windows
+            if any(datetime.date.fromisoformat(date).weekday() < 5 for date in window)
+        ]
+    return windows
+
+
 def get_previous_asset_prices(
     db: Session, target_dates: list[str]
 ) -> dict[str, dict[str, Decimal]]:
     """
     Gets the previous close prices for each stock
-    Returns a mapping of asset -> date -> price
+    Returns a mapping of asset -> date -> price, for the dates without a stored price
+
+    Only the windows of dates missing from the DB are requested. Each one is fetched
+    concurrently, with a separate pool per provider so that the number of in-flight
+    requests stays within each provider's limit
     """
-    stock_prices = {
-        asset: _get_previous_stock_price(asset, target_dates)
-        for asset in config.stock_tickers
-    }
-    crypto_prices = {
-        asset: _get_previous_crypto_price(asset, target_dates)
-        for asset in config.crypto_tokens
-    }
-    all_prices = {**stock_prices, **crypto_prices}
+    sorted_dates = sorted(target_dates)
+    stored_prices = crud.get_stored_prices(db, sorted_dates[0], sorted_dates[-1])
+
+    with (
+        ThreadPoolExecutor(max_workers=config.tiingo_max_concurrency) as tiingo_pool,
+        ThreadPoolExecutor(
+            max_workers=config.coingecko_max_concurrency
+        ) as coingecko_pool,
+    ):
+        window_futures = {
+            asset: [
+                tiingo_pool.submit(_get_previous_stock_price, asset, window)
+                for window in _get_missing_windows(
+                    sorted_dates, set(stored_prices.get(asset, {})), is_stock=True
+                )
+            ]
+            for asset in config.stock_tickers
+        }
+        window_futures.update(
+            {
+                asset: [
+                    coingecko_pool.submit(_get_previous_crypto_price, asset, window)
+                    for window in _get_missing_windows(
+                        sorted_dates, set(stored_prices.get(asset, {})), is_stock=False
+                    )
+                ]
+                for asset in config.crypto_tokens
+            }
+        )
+        all_prices: dict[str, dict[str, Decimal]] = {}
+        for asset, futures in window_futures.items():
+            all_prices[asset] = dict(stored_prices.get(asset, {}))
+            for future in futures:
+                all_prices[asset].update(future.result())
 
-    # Fill missing dates with previous prices from database
+    # Fill missing dates with the previous price
     # This is relevant for stocks which don't have prices when the market is closed on weekends and holidays
-    for asset in all_prices.keys():
-        for date in target_dates:
-            if date not in all_prices[asset]:
-                all_prices[asset][date] = crud.get_latest_asset_price(
-                    db, asset=asset, date=date
-                )
-    return all_prices
+    # The fill is seeded with the latest stored price from before the first date
+    previous_prices = crud.get_latest_asset_prices(
+        db, date=sorted_dates[0], assets=list(all_prices.keys())
+    )
 
+    prices_df = pd.DataFrame(all_prices, index=sorted_dates, dtype=object)
+    seed_row = pd.DataFrame(
+        previous_prices, index=["previous"], columns=prices_df.columns, dtype=object
+    )
+    filled_df = pd.concat([seed_row, prices_df]).ffill().iloc[1:]
 
-def get_current_asset_prices() -> dict[str, Decimal]:
-    """Returns the price of each asset (crypto and stocks)"""
-    return {**_get_current_stock_prices(), **_get_current_crypto_prices()}
+    missing_assets = [
+        asset for asset in filled_df.columns if filled_df[asset].isna().any()
+    ]
+    assert not missing_assets, (
+        f"No previous price found for {', '.join(missing_assets)} before {sorted_dates[0]}"
+    )
 
+    return {
+        asset: {
+            date: price
+            for (date, price) in filled_df[asset].items()
+            if date not in stored_prices.get(asset, {})
+        }
+        for asset in filled_df.columns
+    }
 
-def get_cached_asset_prices(db: Session) -> dict[str, Decimal]:
-    """Fetches prices from the database, or queries the actual prices if the db is stale"""
-    all_price_data = db.query(models.LivePrice).all()
-    assert all_price_data, "No prices found"
 
-    # The updated time should be the same for each asset, so we only have to check the first one
-    last_fetched_time = all_price_data[0].updated_at.astimezone(datetime.timezone.utc)
-    current_time = datetime.datetime.now(datetime.timezone.utc)
-    ttl_length = datetime.timedelta(minutes=config.price_cache_ttl_min)
-    price_is_fresh = current_time - last_fetched_time < ttl_length
+def _collect_results(futures: dict[str, Future], partial: bool) -> dict[str, Any]:
+    """
+    Returns the result of each future, keyed by name
+    With partial, failed price requests are logged and left out instead of raising
+    """
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except InvalidPriceResponse as e:
+            if not partial:
+                raise
+            e.log_error()
+    return results
+
+
+def get_current_asset_prices(
+    partial: bool = False, assets: list[str] | None = None
+) -> dict[str, Decimal]:
+    """
+    Returns the price of each asset (crypto and stocks), or only of the given assets
+    Each stock quote and the crypto quote are requested concurrently, so the latency
+    is that of the slowest request rather than the sum of all of them
+    With partial, assets whose provider failed are left out, rather than failing the
+    whole batch
+    """
+    stock_tickers = [
+        asset for asset in config.stock_tickers if assets is None or asset in assets
+    ]
+    fetch_crypto = assets is None or any(
+        asset in assets for asset in config.crypto_tokens
+    )
+    with ThreadPoolExecutor(max_workers=config.price_fetch_max_workers) as executor:
+        stock_futures = {
+            asset: executor.submit(_get_current_stock_price, asset)
+            for asset in stock_tickers
+        }
+        crypto_futures = (
+            {"crypto": executor.submit(_get_current_crypto_prices)}
+            if fetch_crypto
+            else {}
+        )
+
+        stock_prices = _collect_results(stock_futures, partial)
+        crypto_prices = _collect_results(crypto_futures, partial)
+        return {**stock_prices, **crypto_prices.get("crypto", {})}
+
+
+def _load_live_prices(
+    db: Session,
+) -> tuple[dict[str, Decimal], dict[str, datetime.datetime]]:
+    """
+    Reads the stored live prices of the configured assets, along with the time each
+    of them was fetched
+    """
+    all_price_data = (
+        db.query(models.LivePrice)
+        .where(models.LivePrice.asset.in_(config.assets.keys()))
+        .all()
+    )
+    assert all_price_data, "No prices found"
 
-    # If the price is fresh, just use the one from the DB
     latest_prices = {
         price_data.asset: price_data.price for price_data in all_price_data
     }
-    if price_is_fresh:
-        return latest_prices
-
-    # Otherwise fetch new prices, cache them and then return them
-    # If the price query fails (possibly due to the rate limit, just return the stale prices)
-    try:
-        price_data_dict = get_current_asset_prices()
-        crud.store_live_prices(db, price_data_dict)
-        return price_data_dict
-    except InvalidPriceResponse as e:
-        e.log_error()
-
-    return latest_prices
+    fetched_times = {
+        price_data.asset: price_data.updated_at.astimezone(datetime.timezone.utc)
+        for price_data in all_price_data
+    }
+    return latest_prices, fetched_times
+
+
+def _get_stale_assets(fetched_times: dict[str, datetime.datetime]) -> list[str]:
+    """
+    Returns the configured assets that are due a refresh, including any with no
+    stored price yet
+    """
+    return [
+        asset
+        for asset in config.assets.keys()
+        if asset not in fetched_times or _is_due(fetched_times[asset])
+    ]
+
+
+# Leeway so a scheduled refresh isn't skipped just because the last one landed a few
+# seconds late
+REFRESH_LEEWAY = datetime.timedelta(seconds=30)
+
+
+def is_market_open(at: datetime.datetime | None = None) -> bool:
+    """Checks whether the stock market is open (ignoring holidays)"""
+    at = at or datetime.datetime.now(datetime.timezone.utc)
+    market_time = at.astimezone(ZoneInfo(MARKET_TIMEZONE))
+    return (
+        market_time.weekday() < 5 and MARKET_OPEN <= market_time.time() < MARKET_CLOSE
+    )
+
+
+def get_refresh_interval() -> datetime.timedelta:
+    """
+    Returns how often the live prices should be refreshed
+    Stock prices only move while the market is open, so overnight and on weekends only
+    crypto needs updating and a slower cadence is enough
+    """
+    if is_market_open():
+        return datetime.timedelta(minutes=config.live_price_refresh_market_min)
+    return datetime.timedelta(minutes=config.live_price_refresh_off_hours_min)
+
+
+def _get_age(fetched_at: datetime.datetime) -> datetime.timedelta:
+    """Returns how long ago prices were fetched"""
+    return datetime.datetime.now(datetime.timezone.utc) - fetched_at
+
+
+def _is_due(fetched_at: datetime.datetime) -> bool:
+    """Checks whether prices fetched at the given time should be refreshed"""
+    return _get_age(fetched_at) >= get_refresh_interval() - REFRESH_LEEWAY
+
+
+class LivePriceCache:
+    """
+    In-process cache of the live prices, in front of the prices_live table
+
+    The scheduled refresh job keeps the cache up to date, so reads are always served
+    from memory. If the job falls behind, the stale prices are still returned
+    immediately while a single background refresh fetches new ones, so concurrent
+    requests never wait on (or stampede) the price providers
+
+    Refreshes are scheduled off the time of the last refresh attempt rather than the
+    age of the prices, and only request the assets whose own price is stale. An asset
+    whose provider keeps failing is therefore retried once per refresh interval,
+    without refetching every other asset along with it
+    """
+
+    def __init__(self):
+        self.prices: dict[str, Decimal] | None = None
+        self.refreshed_at: datetime.datetime | None = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get(self, db: Session) -> dict[str, Decimal]:
+        """
+        Returns the cached prices, kicking off a background refresh if they've missed
+        a couple of scheduled refreshes
+        """
+        with self.lock:
+            prices, refreshed_at = self.prices, self.refreshed_at
+
+        # On the first read, populate the cache from the DB, treating the most recently
+        # fetched price as the last refresh
+        if prices is None or refreshed_at is None:
+            prices, fetched_times = _load_live_prices(db)
+            refreshed_at = max(fetched_times.values())
+            self._set(prices, refreshed_at)
+
+        if _get_age(refreshed_at) > 2 * get_refresh_interval():
+            self.refresh_in_background()
+
+        return prices
+
+    def is_due(self) -> bool:
+        """Checks whether it's been long enough since the last refresh for the next one"""
+        with self.lock:
+            refreshed_at = self.refreshed_at
+        return refreshed_at is None or _is_due(refreshed_at)
+
+    def _set(self, prices: dict[str, Decimal], refreshed_at: datetime.datetime):
+        """Updates the cache, unless it was already refreshed more recently"""
+        with self.lock:
+            if self.refreshed_at is None or refreshed_at >= self.refreshed_at:
+                self.prices, self.refreshed_at = prices, refreshed_at
+
+    def refresh_in_background(self):
+        """Starts a refresh thread, unless there's already one in flight"""
+        if self.refreshing:
+            return
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def refresh(self):
+        """
+        Refreshes the cache with a dedicated DB session, unless a refresh is already in flight
+        Only assets whose stored price is due are fetched from the providers, so prices
+        another process has already updated are reused as they are
+        If a provider fails (possibly due to the rate limit), its assets keep their stale
+        prices while the rest are still updated. The attempt still counts as a refresh,
+        so the failing assets are only retried at the next scheduled refresh
+        """
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        refreshed_at = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            with connection.SessionLocal() as db:
+                prices, fetched_times = _load_live_prices(db)
+                stale_assets = _get_stale_assets(fetched_times)
+                if stale_assets:
+                    crud.store_live_prices(
+                        db, get_current_asset_prices(partial=True, assets=stale_assets)
+                    )
+                    prices, _ = _load_live_prices(db)
+            self._set(prices, refreshed_at)
+        except InvalidPriceResponse as e:
+            e.log_error()
+        except Exception as e:
+            logger.error(f"Failed to refresh live prices: {e}")
+        finally:
+            with self.lock:
+                if self.refreshed_at is None or refreshed_at > self.refreshed_at:
+                    self.refreshed_at = refreshed_at
+                self.refreshing = False
+
+
+live_price_cache = LivePriceCache()
+
+
+def get_cached_asset_prices(db: Session) -> dict[str, Decimal]:
+    """
+    Returns the latest prices from the in-process cache
+    If they're stale, they're refreshed in the background rather than making the caller wait
+    """
+    return live_price_cache.get(db)
@@ -0,0 +1,195 @@
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any
+import requests
+from requests.adapters import HTTPAdapter
+from backend.config import config, logger, InvalidPriceResponse
+
+# Status codes that are worth retrying, since they're transient on the provider's end
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that allows up to `capacity` requests per `period_sec`,
+    refilling continuously. Callers block until a token is available
+    """
+
+    def __init__(self, capacity: int, period_sec: float):
+        self.capacity = capacity
+        self.refill_rate = capacity / period_sec
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Waits for and consumes a single token"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.blocked_until:
+                    elapsed = now - max(self.updated_at, self.blocked_until)
+                    self.tokens = min(
+                        self.capacity, self.tokens + elapsed * self.refill_rate
+                    )
+                    self.updated_at = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait_sec = (1 - self.tokens) / self.refill_rate
+                else:
+                    wait_sec = self.blocked_until - now
+
+            time.sleep(wait_sec)
+
+    def block(self, seconds: float):
+        """Stops handing out tokens for the given duration (e.g. after a rate limit response)"""
+        with self.lock:
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """Parses a Retry-After header, which is either a number of seconds or an HTTP date"""
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+class ProviderClient:
+    """
+    Shared HTTP client for a single price provider
+    Requests reuse pooled keep-alive connections, are throttled to the provider's rate limit,
+    and transient failures are retried with jittered exponential backoff (or after the
+    provider's Retry-After when given)
+    """
+
+    def __init__(self, source: str, rate_limit: tuple[int, int]):
+        self.source = source
+        self.bucket = TokenBucket(*rate_limit)
+
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=config.price_fetch_max_workers
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get_json(
+        self,
+        url: str,
+        price_type: str,
+        params: dict[str, Any] | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> Any:
+        """
+        Sends a GET request and returns the decoded JSON body
+        Raises an InvalidPriceResponse if the request still fails after all retries
+        """
+        error_data: dict = {}
+        for attempt in range(config.provider_max_retries + 1):
+            self.bucket.acquire()
+
+            retry_after = None
+            try:
+                response = self.session.get(
+                    url,
+                    params=params,
+                    headers=headers,
+                    timeout=config.price_request_timeout_sec,
+                )
+            except requests.RequestException as e:
+                error_data = {"error": str(e)}
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    try:
+                        return response.json()
+                    except ValueError as e:
+                        raise InvalidPriceResponse(
+                            price_type=price_type,
+                            source=self.source,
+                            response_data={
+                                "status": response.status_code,
+                                "body": response.text,
+                            },
+                        ) from e
+
+                error_data = {"status": response.status_code, "body": response.text}
+                retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+                if response.status_code == 429:
+                    self.bucket.block(retry_after or config.provider_backoff_sec)
+
+            if attempt == config.provider_max_retries:
+                break
+
+            backoff_sec = config.provider_backoff_sec * 2**attempt
+            wait_sec = min(
+                retry_after or random.uniform(0, backoff_sec) + backoff_sec / 2,
+                config.provider_max_retry_wait_sec,
+            )
+            logger.warning(
+                f"{self.source} request failed ({error_data}), retrying in {wait_sec:.1f}s"
+            )
+            time.sleep(wait_sec)
+
+        raise InvalidPriceResponse(
+            price_type=price_type, source=self.source, response_data=error_data
+        )
+
+
+class ResponseCache:
+    """
+    On-disk cache of raw provider responses, keyed by (provider, asset, date range)
+    Closes for past dates don't change, so entries never expire, and re-running a fetch
+    after a partial failure doesn't spend any requests on the ranges that succeeded
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+
+    def _get_path(
+        self, source: str, asset: str, start_date: str, end_date: str
+    ) -> Path:
+        return self.cache_dir / source.lower() / f"{asset}_{start_date}_{end_date}.json"
+
+    def get(self, source: str, asset: str, start_date: str, end_date: str) -> Any:
+        """Returns the cached response, or None if there isn't a readable one"""
+        path = self._get_path(source, asset, start_date, end_date)
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def set(self, source: str, asset: str, start_date: str, end_date: str, data: Any):
+        """
+        Caches a response, writing it atomically so readers never see a partial file
+        Failing to write is only logged, since the response itself is still usable
+        """
+        path = self._get_path(source, asset, start_date, end_date)
+        temp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path.write_text(json.dumps(data))
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to cache {source} response for {asset}: {e}")
+
+
+finhub = ProviderClient("FinHub", config.finhub_rate_limit)
+tiingo = ProviderClient("Tiingo", config.tiingo_rate_limit)
+coingecko = ProviderClient("Coingecko", config.coingecko_rate_limit)
+
+response_cache = ResponseCache(config.price_response_cache_dir)
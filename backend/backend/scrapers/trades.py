@@ -1,15 +1,31 @@
 import datetime
 import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 from ibind import IbkrClient
 from backend.config import config, Platform
 from backend.database import models, crud
-from coinbase.rest import RESTClient
+from backend.scrapers.brokers import broker_clients
 from sqlalchemy.orm import Session
 
+# Existing trades keyed by (asset, date, action)
+TradeIndex = dict[tuple[str, str, str], list[models.Trade]]
 
-def trade_has_id_conflict(db: Session, new_trade: models.Trade) -> bool:
+
+def get_trade_index(db: Session, start_date: datetime.date) -> TradeIndex:
+    """
+    Loads every existing trade since the start date (inclusive) in a single query,
+    indexed by (asset, date, action) for conflict checks
+    """
+    trade_index: TradeIndex = defaultdict(list)
+    for trade in crud.get_trades(db, start_date=start_date):
+        trade_index[(trade.asset, str(trade.date), trade.action)].append(trade)
+    return trade_index
+
+
+def trade_has_id_conflict(trade_index: TradeIndex, new_trade: models.Trade) -> bool:
     """
     The values in the IBKR response can change mildly as the order is filled, but there's
     no single ID field we can use to know this for sure
@@ -25,11 +41,10 @@ def trade_has_id_conflict(db: Session, new_trade: models.Trade) -> bool:
     NOT seem to be a duplicate, then we consider that a conflict, which lets us know
     that we need to generate a new ID
     """
-    existing_trades = crud.get_trades(db, asset=new_trade.asset, date=new_trade.date)
+    existing_trades = trade_index.get(
+        (new_trade.asset, str(new_trade.date), new_trade.action), []
+    )
     for existing in existing_trades:
-        if existing.action != new_trade.action:
-            continue
-
         # Skip if existing values are zero (would cause division by zero)
         if existing.quantity == 0 or existing.price == 0:
             continue
@@ -46,37 +61,59 @@ def trade_has_id_conflict(db: Session, new_trade: models.Trade) -> bool:
     return False
 
 
+def _get_ibkr_transactions(
+    client: IbkrClient, contract_id: str, days: int
+) -> list[dict[str, str | int]]:
+    """Fetches the transaction history for a single IBKR contract over the last given days"""
+    transactions_raw = client.transaction_history(
+        config.ibkr_account_id,
+        contract_id,
+        "USD",
+        days,  # type: ignore
+    )
+    if not transactions_raw.data or "transactions" not in transactions_raw.data:
+        return []
+    return transactions_raw.data["transactions"]  # type: ignore
+
+
 def get_recent_ibkr_trades(
-    db: Session, start_date: datetime.date
+    start_date: datetime.date, trade_index: TradeIndex
 ) -> list[models.Trade]:
     """
     Scrapes recent IBKR trades
     :param start_date: First date to query orders from, inclusively
+    :param trade_index: Existing trades since the start date (from get_trade_index),
+        loaded up front so conflict checks don't query the DB per transaction
     """
-    client = IbkrClient(**config.ibind_client_params)
-    client.tickle()
-
-    trades = []
-    for asset_info in config.assets.values():
-        if asset_info.platform != Platform.IBKR:
-            continue
-
-        contract_id = asset_info.contract_id
-        assert contract_id, f"Contract ID not provided for {asset_info.asset}"
+    client = broker_clients.get_ibkr()
+
+    ibkr_assets = [
+        asset_info
+        for asset_info in config.assets.values()
+        if asset_info.platform == Platform.IBKR
+    ]
+    for asset_info in ibkr_assets:
+        assert asset_info.contract_id, (
+            f"Contract ID not provided for {asset_info.asset}"
+        )
 
-        current_date = datetime.date.today()
-        days = (current_date - start_date).days + 1
+    current_date = datetime.date.today()
+    days = (current_date - start_date).days + 1
 
-        transactions_raw = client.transaction_history(
-            config.ibkr_account_id,
-            contract_id,
-            "USD",
-            days,  # type: ignore
-        )
-        if not transactions_raw.data or "transactions" not in transactions_raw.data:
-            continue
-        transactions: list[dict[str, str | int]] = transactions_raw.data["transactions"]  # type: ignore
+    # Fetch each contract's history concurrently over the shared client session,
+    # capping the number of in-flight requests to the gateway
+    with ThreadPoolExecutor(max_workers=config.ibkr_max_concurrency) as executor:
+        transaction_futures = [
+            executor.submit(
+                _get_ibkr_transactions, client, asset_info.contract_id, days
+            )
+            for asset_info in ibkr_assets
+        ]
 
+    # Results are processed in asset order so the output is deterministic
+    trades = []
+    for asset_info, future in zip(ibkr_assets, transaction_futures):
+        transactions = future.result()
         for transaction in transactions:
             if transaction["type"] not in ["Buy", "Sell"]:
                 continue
@@ -113,7 +150,7 @@ def get_recent_ibkr_trades(
             # a different quantity or price
             # If we do, we need to generate a new ID; if we don't, we can just leave
             # it as is which will upsert on conflict with the latest value for dupes
-            if trade_has_id_conflict(db, trade):
+            if trade_has_id_conflict(trade_index, trade):
                 suffix = f"{quantity}_{price}_{cost}_{value}"
                 id_string = f"{id_string}_{suffix}"
                 trade.id = f"ibkr-{hashlib.sha256(id_string.encode()).hexdigest()[:20]}"
@@ -128,9 +165,7 @@ def get_recent_coinbase_trades(start_date: datetime.date) -> list[models.Trade]:
     Scrapes recent coinbase trades since the last specified date
     :param start_date: First date to query orders from, inclusively
     """
-    client = RESTClient(
-        api_key=config.coinbase_api_key, api_secret=config.coinbase_api_secret
-    )
+    client = broker_clients.get_coinbase()
 
     trades = []
     orders = client.list_orders(